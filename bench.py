@@ -0,0 +1,202 @@
+import os
+import json
+import shutil
+import time
+import socket
+import argparse
+import statistics
+from simpoint_utils import (
+    gem5_command, run_gem5, find_checkpoints, is_complete)
+
+
+# Measure how fast this host (and gem5 build) runs the scripts of this
+# project, phase by phase, from the host_profile.jsonl timelines of a few
+# small runs on the fib program compiled by checkpoint.py:
+#   atomic_kips       AtomicSimpleCPU simulate() in create_by_fixed_insts
+#   ckpt_write_mbps   m5.checkpoint() in create_by_fixed_insts
+#   ckpt_read_mbps    m5.instantiate(ckpt) in restore
+#   o3_kips           O3CPU simulate() after the switch in restore_and_switch
+#   switch_ms         m5.switchCpus() in switch_repeatedly
+#   sample_kips       spec_simpoint.py sample, atomic and detailed mixed
+#   rate_create_kips  spec_simpoint.py create --cores 2 into a clean
+#                     --cpt-dir, which also checks that rate mode works
+# Compared with a baseline, a metric more than --tolerance worse is flagged.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# True if larger is better
+METRICS = {
+    'atomic_kips': True,
+    'ckpt_write_mbps': True,
+    'ckpt_read_mbps': True,
+    'o3_kips': True,
+    'switch_ms': False,
+    'sample_kips': True,
+    'rate_create_kips': True,
+}
+
+
+######################################
+#          Argument Parsing          #
+######################################
+
+parser = argparse.ArgumentParser(
+    description='Benchmark host throughput of the simulation scripts.')
+parser.add_argument('--gem5', default='build/RISCV/gem5.opt')
+parser.add_argument('--workdir', default='bench_work')
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--baseline', help='JSON written by --save')
+parser.add_argument('--save', help='write the results as a baseline')
+parser.add_argument('--tolerance', type=float, default=0.1)
+
+
+#######################################
+#                 Runs                #
+#######################################
+
+
+def du(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            total += os.path.getsize(os.path.join(dirpath, fn))
+    return total
+
+
+def run(args, outdir, script, script_args):
+    # Run gem5 in workdir (checkpoint.py compiles hello.exe there) and
+    # return the host_profile records of the run
+    cmd = gem5_command(os.path.abspath(args.gem5), outdir,
+                       os.path.join(HERE, script),
+                       list(script_args) + ['--host-profile'])
+    if not run_gem5(cmd, outdir, cwd=args.workdir):
+        print('Failed: %s, see %r' % (' '.join(script_args),
+                                      os.path.join(outdir, 'gem5.log')))
+        exit(-1)
+    with open(os.path.join(outdir, 'host_profile.jsonl')) as f:
+        return [json.loads(line) for line in f]
+
+
+def kips(records):
+    sims = [r for r in records if r['call'] == 'simulate']
+    wall = sum(r['wall'] for r in sims)
+    return sum(r['insts'] for r in sims) / wall / 1000 if wall else None
+
+
+def mbps(records, call):
+    # Bytes of the checkpoint directories per host second
+    calls = [r for r in records if r['call'] == call and 'dir' in r]
+    wall = sum(r['wall'] for r in calls)
+    size = sum(du(r['dir']) for r in calls)
+    return size / wall / 2**20 if wall else None
+
+
+def measure(args, rep):
+    outdir = os.path.abspath(os.path.join(args.workdir, 'm5out.%d' % rep))
+    metrics = {}
+
+    records = run(args, outdir, 'checkpoint.py', ['create_by_fixed_insts'])
+    metrics['atomic_kips'] = kips(records)
+    metrics['ckpt_write_mbps'] = mbps(records, 'checkpoint')
+
+    records = run(args, outdir, 'checkpoint.py', ['restore'])
+    metrics['ckpt_read_mbps'] = mbps(records, 'instantiate')
+
+    records = run(args, outdir, 'checkpoint.py', ['restore_and_switch'])
+    switched = [i for i, r in enumerate(records)
+                if r['call'] == 'switchCpus']
+    if switched:
+        metrics['o3_kips'] = kips(records[switched[0] + 1:])
+
+    records = run(args, outdir, 'checkpoint.py', ['switch_repeatedly'])
+    switches = [r['wall'] for r in records if r['call'] == 'switchCpus']
+    if switches:
+        metrics['switch_ms'] = 1000 * statistics.mean(switches)
+
+    records = run(args, outdir + '.sample', 'spec_simpoint.py', [
+        'sample', '--sample-period', '20000', '--sample-warmup', '1000',
+        '--sample-unit', '1000', '--min-samples', '5',
+        '--sample-error', '1', 'hello.exe'])
+    metrics['sample_kips'] = kips(records)
+
+    # One SimPoint at [20000, 30000) insts, written by hand instead of
+    # profiling and clustering
+    cpt_dir = outdir + '.rate'
+    shutil.rmtree(cpt_dir, ignore_errors=True)
+    os.makedirs(cpt_dir)
+    with open(os.path.join(cpt_dir, 'simpoints.txt'), 'w') as f:
+        f.write('2 0\n')
+    with open(os.path.join(cpt_dir, 'weights.txt'), 'w') as f:
+        f.write('1 0\n')
+    records = run(args, os.path.join(cpt_dir, 'create'), 'spec_simpoint.py', [
+        'create', '--cores', '2', '--cpt-dir', cpt_dir, '--interval', '10000',
+        '--warmup', '1000', 'hello.exe'])
+    rate_dir = os.path.join(cpt_dir, 'cores_2')
+    if not os.path.isdir(rate_dir) or not any(
+            is_complete(cpt.path) for cpt in find_checkpoints(rate_dir)):
+        print('Failed: no rate mode checkpoint in %r' % cpt_dir)
+        exit(-1)
+    metrics['rate_create_kips'] = kips(records)
+    return {k: v for k, v in metrics.items() if v is not None}
+
+
+#######################################
+#              Comparison             #
+#######################################
+
+
+def compare(results, baseline, tolerance):
+    # Return the names of metrics that regressed
+    regressed = []
+    print('%-16s %12s %12s %9s' % ('metric', 'value', 'baseline', 'change'))
+    for name, higher_better in METRICS.items():
+        if name not in results:
+            continue
+        value = results[name]
+        base = baseline.get(name)
+        if not base:
+            print('%-16s %12.2f' % (name, value))
+            continue
+        change = value / base - 1
+        worse = -change if higher_better else change
+        flag = ''
+        if worse > tolerance:
+            regressed.append(name)
+            flag = '  REGRESSION'
+        print('%-16s %12.2f %12.2f %+8.1f%%%s'
+              % (name, value, base, 100 * change, flag))
+    return regressed
+
+
+def main():
+    args = parser.parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+
+    runs = []
+    for rep in range(args.repeat):
+        print('Run %d/%d' % (rep + 1, args.repeat))
+        runs.append(measure(args, rep))
+    # The median is robust against a run disturbed by other load
+    results = {name: statistics.median(r[name] for r in runs if name in r)
+               for name in METRICS if any(name in r for r in runs)}
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['metrics']
+    regressed = compare(results, baseline, args.tolerance)
+
+    if args.save is not None:
+        gem5 = os.path.realpath(args.gem5)
+        with open(args.save, 'w') as f:
+            json.dump({'metrics': results, 'runs': runs,
+                       'host': socket.gethostname(), 'gem5': gem5,
+                       'gem5_mtime': os.stat(gem5).st_mtime,
+                       'time': time.time()}, f, indent=2)
+    if regressed:
+        print('Regressed: %s' % ', '.join(regressed))
+    exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import os
+import shutil
 import builtins
 import argparse
 import subprocess
@@ -7,6 +8,10 @@ from m5.objects import (
     System, SrcClockDomain, VoltageDomain,
     Cache, SystemXBar, L2XBar, MemCtrl, AddrRange, DDR3_1600_8x8,
     AtomicSimpleCPU, O3CPU, SEWorkload, Process, Root)
+import host_profile
+import telemetry
+from stat_sampler import StatSampler
+from simpoint_utils import is_complete, mark_complete
 
 
 def print(*args, **kwargs):
@@ -25,9 +30,23 @@ parser.add_argument('action', choices=[
     'simpoint_profile',
     'take_simpoint_checkpoints',
     'restore_simpoint'])
+parser.add_argument('--host-profile', action='store_true')
+parser.add_argument('--telemetry')
+parser.add_argument('--telemetry-interval', type=float, default=30)
+parser.add_argument('--sample-stats',
+                    help='comma-separated stats to sample at every switch')
 args = parser.parse_args()
 action = args.action
 
+# Publish progress to a textfile, see telemetry.py
+if args.telemetry is not None:
+    telemetry.install(args.telemetry, args.telemetry_interval)
+
+# Record host time of every instantiate/simulate/checkpoint/switch call
+if args.host_profile:
+    host_profile.install(
+        os.path.join(m5.options.outdir, 'host_profile.jsonl'))
+
 # Compile helloworld executable
 c_src = 'hello.c'
 binary = 'hello.exe'
@@ -198,11 +217,26 @@ if action == 'take_simpoint_checkpoints':
         w = float(wl.split()[0])
         simpoints.append((s, w))
 
-    # Compute start insts
+    # Resume from the last complete checkpoint taken by a previous run, as
+    # spec_simpoint.py create does. weight.txt is written last.
     simpoints.sort()
+    num_taken = 0
+    base_insts = 0
+    while num_taken < len(simpoints):
+        path = os.path.join(m5out, 'ckpt.%03d' % (num_taken + 1))
+        if not (os.path.exists(os.path.join(path, 'weight.txt'))
+                and is_complete(path)):
+            break
+        num_taken += 1
+    if num_taken:
+        ckpt_dir = os.path.join(m5out, 'ckpt.%03d' % num_taken)
+        base_insts = simpoints[num_taken - 1][0] * simpoint_interval
+        print('Found %d checkpoints, resume from' % num_taken, repr(ckpt_dir))
+
+    # Compute start insts, relative to the restored checkpoint if any
     simpoint_start_insts = []
-    for s, _ in simpoints:
-        insts = s * simpoint_interval
+    for s, _ in simpoints[num_taken:]:
+        insts = s * simpoint_interval - base_insts
         simpoint_start_insts.append(insts)
     system.cpu.simpoint_start_insts = simpoint_start_insts
 
@@ -248,6 +282,7 @@ elif action == 'create_by_fixed_insts':
     while True:
         print('Simulate for %d insts' % interval_insts)
         system.cpu.scheduleInstStop(tid, interval_insts, event_str)
+        telemetry.expect(interval_insts)
         exit_event = m5.simulate()
         if exit_event.getCause() != event_str:
             break
@@ -278,42 +313,64 @@ elif action == 'switch_repeatedly':
     tid = 0
     event_str = 'inst stop'
 
+    # Sample the chosen stats into a binary file instead of dumping all
+    sampler = None
+    if args.sample_stats:
+        sampler = StatSampler(os.path.join(m5out, 'stats.samples'),
+                              args.sample_stats.split(','))
+
     while True:
         print('Simulate for %d insts' % interval_insts)
         curr_cpu = switch_cpu_list[0][0]
         curr_cpu.scheduleInstStop(tid, interval_insts, event_str)
+        telemetry.expect(interval_insts)
         exit_event = m5.simulate()
         if exit_event.getCause() != event_str:
             break
 
         print('Pause @ tick', m5.curTick())
+        if sampler is not None:
+            sampler.sample()
         print('Switch %s -> %s' % (switch_cpu_list[0]))
         m5.switchCpus(system, switch_cpu_list)
 
         # Reverse each CPU pair in switch_cpu_list
         switch_cpu_list = [(p[1], p[0]) for p in switch_cpu_list]
 
+    if sampler is not None:
+        sampler.close()
+
 elif action == 'simpoint_profile':
     print('Simulate and profile for SimPoint')
     exit_event = m5.simulate()
 
 elif action == 'take_simpoint_checkpoints':
-    for i, (s, w) in enumerate(simpoints, 1):
+    insts = 0
+    for i, ((s, w), ssi) in enumerate(
+            zip(simpoints[num_taken:], simpoint_start_insts), num_taken + 1):
         print('Simulate until next simpoint entry')
+        telemetry.expect(ssi - insts)
+        insts = ssi
         exit_event = m5.simulate()
 
         if exit_event.getCause() == 'simpoint starting point found':
             print('Take simpoint %d @ tick %d' % (s, m5.curTick()))
             ckpt_dir = os.path.join(m5out, 'ckpt.%03d' % i)
+            # Left incomplete by a killed run, don't mix its files with ours
+            if os.path.exists(ckpt_dir):
+                print('Remove incomplete checkpoint', repr(ckpt_dir))
+                shutil.rmtree(ckpt_dir)
             m5.checkpoint(ckpt_dir)
             with open(os.path.join(ckpt_dir, 'weight.txt'), 'w') as f:
                 f.write(str(w))
+            mark_complete(ckpt_dir)
 
     print('Simulate to end')
     exit_event = m5.simulate()
 
 elif action == 'restore_simpoint':
     print('Simulate simpoint for %d insts' % simpoint_interval)
+    telemetry.expect(simpoint_interval)
     exit_event = m5.simulate()
 
 print('Exiting @ tick %d because %s' % (m5.curTick(), exit_event.getCause()))
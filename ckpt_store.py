@@ -0,0 +1,250 @@
+import os
+import sys
+import gzip
+import json
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import zlib
+import argparse
+from array import array
+from simpoint_utils import read_stores, mark_complete
+
+
+# A checkpoint in the store is a directory holding every file of the
+# original checkpoint except the pmem stores. Each store is replaced by
+# <pmem>.chunks, an array of chunk ids (0 for an all-zero chunk). Unique
+# chunks are kept once, zlib-compressed, in pack files indexed by SQLite.
+
+CHUNK_SIZE = 4096
+COMMIT_CHUNKS = 4096
+MANIFEST = 'manifest.json'
+
+
+def open_index(store):
+    os.makedirs(os.path.join(store, 'packs'), exist_ok=True)
+    os.makedirs(os.path.join(store, 'ckpts'), exist_ok=True)
+    db = sqlite3.connect(os.path.join(store, 'index.sqlite'), timeout=600)
+    db.execute('CREATE TABLE IF NOT EXISTS chunks ('
+               'id INTEGER PRIMARY KEY, hash BLOB UNIQUE, '
+               'pack TEXT, offset INTEGER, length INTEGER)')
+    return db
+
+
+def open_pmem(path):
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rb'), True
+    return open(path, 'rb'), False
+
+
+def list_names(store):
+    try:
+        names = os.listdir(os.path.join(store, 'ckpts'))
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if not name.endswith('.tmp'))
+
+
+def contains(store, name):
+    return os.path.isdir(os.path.join(store, 'ckpts', name))
+
+
+#######################################
+#                Pack                 #
+#######################################
+
+
+def commit(db, pf):
+    # Chunks must be durable before the index (and so any checkpoint)
+    # refers to them. Committing in batches keeps concurrent packs from
+    # waiting on the write lock for a whole pack.
+    pf.flush()
+    os.fsync(pf.fileno())
+    db.commit()
+
+
+def pack(store, ckpt_dir, name=None, chunk_size=CHUNK_SIZE, level=1):
+    name = name or os.path.basename(os.path.normpath(ckpt_dir))
+    dst = os.path.join(store, 'ckpts', name)
+    tmp = dst + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    stores = read_stores(ckpt_dir)
+    pmems = {pmem for pmem, _ in stores}
+    for fn in os.listdir(ckpt_dir):
+        if fn not in pmems:
+            shutil.copy2(os.path.join(ckpt_dir, fn), os.path.join(tmp, fn))
+
+    db = open_index(store)
+    pack_name = uuid.uuid4().hex
+    zero = bytes(chunk_size)
+    manifest = {}
+    new_bytes = 0
+    pending = 0
+    with open(os.path.join(store, 'packs', pack_name), 'ab') as pf:
+        for pmem, size in stores:
+            ids = array('Q')
+            f, gzipped = open_pmem(os.path.join(ckpt_dir, pmem))
+            with f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    if chunk == zero[:len(chunk)]:
+                        ids.append(0)
+                        continue
+                    h = hashlib.blake2b(chunk, digest_size=20).digest()
+                    row = db.execute('SELECT id FROM chunks WHERE hash = ?',
+                                     (h,)).fetchone()
+                    if row is None:
+                        data = zlib.compress(chunk, level)
+                        offset = pf.tell()
+                        pf.write(data)
+                        cur = db.execute(
+                            'INSERT OR IGNORE INTO chunks '
+                            '(hash, pack, offset, length) '
+                            'VALUES (?, ?, ?, ?)',
+                            (h, pack_name, offset, len(data)))
+                        if cur.rowcount:
+                            row = (cur.lastrowid,)
+                            new_bytes += len(data)
+                            pending += 1
+                        else:
+                            # A concurrent pack committed the same chunk
+                            pf.truncate(offset)
+                            pf.seek(offset)
+                            row = db.execute(
+                                'SELECT id FROM chunks WHERE hash = ?',
+                                (h,)).fetchone()
+                    ids.append(row[0])
+                    if pending >= COMMIT_CHUNKS:
+                        commit(db, pf)
+                        pending = 0
+            with open(os.path.join(tmp, pmem + '.chunks'), 'wb') as cf:
+                ids.tofile(cf)
+            manifest[pmem] = {'size': size, 'chunk_size': chunk_size,
+                              'gzip': gzipped}
+
+        commit(db, pf)
+    if not new_bytes:
+        os.remove(os.path.join(store, 'packs', pack_name))
+    db.close()
+    with open(os.path.join(tmp, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(dst, ignore_errors=True)
+    os.replace(tmp, dst)
+    return new_bytes
+
+
+#######################################
+#             Materialize             #
+#######################################
+
+
+def materialize(store, name, dst, compress=False):
+    # Rebuild a normal gem5 checkpoint directory. pmem stores are written as
+    # sparse raw files unless compress is set: gem5 reads them through
+    # gzread(), which passes non-gzip files through as is.
+    src = os.path.join(store, 'ckpts', name)
+    with open(os.path.join(src, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    tmp = os.path.normpath(dst) + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for fn in os.listdir(src):
+        if fn != MANIFEST and not fn.endswith('.chunks'):
+            shutil.copy2(os.path.join(src, fn), os.path.join(tmp, fn))
+
+    db = open_index(store)
+    packs = {}
+    try:
+        for pmem, info in manifest.items():
+            ids = array('Q')
+            with open(os.path.join(src, pmem + '.chunks'), 'rb') as cf:
+                ids.frombytes(cf.read())
+            chunk_size, size = info['chunk_size'], info['size']
+            zero = bytes(chunk_size)
+            path = os.path.join(tmp, pmem)
+            out = gzip.open(path, 'wb', 1) if compress else open(path, 'wb')
+            with out:
+                for i in ids:
+                    if i == 0:
+                        if compress:
+                            out.write(zero)
+                        else:
+                            out.seek(chunk_size, os.SEEK_CUR)
+                        continue
+                    pack_name, offset, length = db.execute(
+                        'SELECT pack, offset, length FROM chunks WHERE id = ?',
+                        (i,)).fetchone()
+                    if pack_name not in packs:
+                        packs[pack_name] = open(
+                            os.path.join(store, 'packs', pack_name), 'rb')
+                    pf = packs[pack_name]
+                    pf.seek(offset)
+                    out.write(zlib.decompress(pf.read(length)))
+                if not compress:
+                    out.truncate(size)
+    finally:
+        for pf in packs.values():
+            pf.close()
+        db.close()
+
+    mark_complete(tmp)
+    shutil.rmtree(dst, ignore_errors=True)
+    os.replace(tmp, dst)
+
+
+#######################################
+#         Command Line Interface      #
+#######################################
+
+
+def du(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            total += os.stat(os.path.join(root, fn)).st_blocks * 512
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Deduplicated store of gem5 checkpoints.')
+    parser.add_argument('action', choices=['pack', 'unpack', 'list'])
+    parser.add_argument('store')
+    parser.add_argument('ckpts', nargs='*')
+    parser.add_argument('-o', '--outdir', default='.')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--remove', action='store_true')
+    args = parser.parse_args()
+
+    if args.action == 'pack':
+        for ckpt_dir in args.ckpts:
+            size = du(ckpt_dir)
+            new_bytes = pack(args.store, ckpt_dir, chunk_size=args.chunk_size)
+            print('Packed %r: %d bytes on disk, %d new bytes in store'
+                  % (ckpt_dir, size, new_bytes))
+            if args.remove:
+                shutil.rmtree(ckpt_dir)
+
+    elif args.action == 'unpack':
+        for name in args.ckpts:
+            dst = os.path.join(args.outdir, name)
+            print('Materializing %r' % dst)
+            materialize(args.store, name, dst, args.gzip)
+
+    else:
+        for name in list_names(args.store):
+            print(name)
+        print('Store size: %d bytes' % du(args.store), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+import os
+import re
+import gzip
+import json
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+# A converted trace is a directory of chunks, each column of a chunk being
+# one .npy file that can be memory-mapped:
+#   <chunk>.tick.npy    uint64  tick of the line
+#   <chunk>.pc.npy      uint64  PC (micro-op index dropped)
+#   <chunk>.op.npy      uint16  index into meta.json's "mnemonics"
+#   <chunk>.kernel.npy  bool    PC in the upper half of the address space
+# meta.json is written last, so a directory without it is incomplete.
+
+META = 'meta.json'
+COLUMNS = ['tick', 'pc', 'op', 'kernel']
+
+# Lines written by ExecEnable, with ExecThread also prefixed by "T0 : ", e.g.
+#    500: system.cpu: 0x10116    : auipc gp, 4                :
+#   1500: system.cpu: 0x4001a.1 @main+6    : ld a0, 0(sp)      : MemRead ...
+#   2000: system.cpu: T0 : 0x4001e    : addi a1, a0, 1    : IntAlu :
+EXEC_RE = re.compile(
+    rb'^\s*(\d+): [^:\n]+: (?:T\d+ : )?0x([0-9a-fA-F]+)(?:\.\d+)?'
+    rb'(?: @\S+)?\s*: (\S+)',
+    re.MULTILINE)
+
+KERNEL_PC = 1 << 63
+
+
+######################################
+#          Argument Parsing          #
+######################################
+
+parser = argparse.ArgumentParser(
+    description='Convert gem5 Exec traces to columnar arrays and query them.')
+sub = parser.add_subparsers(dest='action', required=True)
+
+p = sub.add_parser('convert')
+p.add_argument('trace', help='debug.log or debug.log.gz')
+p.add_argument('-o', '--outdir', required=True)
+p.add_argument('--block-size', type=int, default=64 << 20)
+p.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+
+for name in ['pc-hist', 'mix', 'hot-bb']:
+    p = sub.add_parser(name)
+    p.add_argument('tracedir')
+    p.add_argument('--top', type=int, default=20)
+    p.add_argument('--space', choices=['all', 'user', 'kernel'],
+                   default='all')
+    if name == 'hot-bb':
+        p.add_argument('--max-insn-size', type=int, default=4)
+
+
+#######################################
+#              Conversion             #
+#######################################
+
+
+def read_blocks(path, block_size):
+    # Yield blocks of whole lines
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            yield block + f.readline()
+
+
+def parse_block(block):
+    matches = EXEC_RE.findall(block)
+    if not matches:
+        return None
+    ticks, pcs, ops = zip(*matches)
+    tick = np.array(ticks).astype(np.uint64)
+    pc = np.array([int(pc, 16) for pc in pcs], np.uint64)
+    names, op = np.unique(np.array(ops), return_inverse=True)
+    return tick, pc, [n.decode() for n in names], op
+
+
+def convert(args):
+    os.makedirs(args.outdir, exist_ok=True)
+    meta_path = os.path.join(args.outdir, META)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    mnemonics = {}
+    chunks = 0
+    lines = 0
+
+    def write_chunk(result):
+        nonlocal chunks, lines
+        if result is None:
+            return
+        tick, pc, names, op = result
+        ids = np.array([mnemonics.setdefault(n, len(mnemonics))
+                        for n in names], np.uint16)
+        columns = {'tick': tick, 'pc': pc, 'op': ids[op],
+                   'kernel': pc >= np.uint64(KERNEL_PC)}
+        for col in COLUMNS:
+            np.save(os.path.join(args.outdir, '%05d.%s.npy' % (chunks, col)),
+                    columns[col])
+        chunks += 1
+        lines += len(tick)
+
+    # Blocks are parsed in parallel, keeping at most 2 * jobs in flight so
+    # memory stays bounded however large the trace is
+    with ProcessPoolExecutor(args.jobs) as pool:
+        pending = collections.deque()
+        for block in read_blocks(args.trace, args.block_size):
+            pending.append(pool.submit(parse_block, block))
+            if len(pending) >= 2 * args.jobs:
+                write_chunk(pending.popleft().result())
+        while pending:
+            write_chunk(pending.popleft().result())
+
+    with open(meta_path, 'w') as f:
+        json.dump({'trace': os.path.abspath(args.trace), 'chunks': chunks,
+                   'lines': lines, 'mnemonics': list(mnemonics)}, f)
+    print('Converted %d lines into %d chunks in %r'
+          % (lines, chunks, args.outdir))
+    if not lines:
+        print('No Exec lines found in %r, was it traced with ExecEnable?'
+              % args.trace)
+
+
+#######################################
+#               Queries               #
+#######################################
+
+
+def load_meta(tracedir):
+    try:
+        with open(os.path.join(tracedir, META)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        print('%r is not a converted trace (or incomplete)' % tracedir)
+        exit(-1)
+
+
+def iter_chunks(tracedir, meta, columns):
+    for i in range(meta['chunks']):
+        yield {col: np.load(os.path.join(tracedir, '%05d.%s.npy' % (i, col)),
+                            mmap_mode='r')
+               for col in columns}
+
+
+def space_mask(chunk, space):
+    if space == 'user':
+        return ~chunk['kernel']
+    if space == 'kernel':
+        return chunk['kernel']
+    return slice(None)
+
+
+def merge_counts(keys, counts):
+    # Sum counts of equal keys given as lists of per-chunk arrays
+    if not keys:
+        return np.zeros(0, np.uint64), np.zeros(0, np.int64)
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    return keys, np.bincount(inverse, np.concatenate(counts)).astype(np.int64)
+
+
+def print_top(title, rows, total, top):
+    print('%-24s %14s %8s' % (title, 'count', '%'))
+    for key, count in rows[:top]:
+        print('%-24s %14d %7.2f%%' % (key, count, 100 * count / max(total, 1)))
+    print('%-24s %14d' % ('total', total))
+
+
+def pc_hist(args, meta):
+    keys, counts = [], []
+    for chunk in iter_chunks(args.tracedir, meta, ['pc', 'kernel']):
+        k, c = np.unique(chunk['pc'][space_mask(chunk, args.space)],
+                         return_counts=True)
+        keys.append(k)
+        counts.append(c)
+    pcs, counts = merge_counts(keys, counts)
+    order = np.argsort(-counts, kind='stable')
+    rows = [('0x%x' % pcs[i], counts[i]) for i in order[:args.top]]
+    print_top('pc', rows, int(counts.sum()), args.top)
+
+
+def mix(args, meta):
+    names = meta['mnemonics']
+    counts = np.zeros(len(names), np.int64)
+    for chunk in iter_chunks(args.tracedir, meta, ['op', 'kernel']):
+        counts += np.bincount(chunk['op'][space_mask(chunk, args.space)],
+                              minlength=len(names))
+    order = np.argsort(-counts, kind='stable')
+    rows = [(names[i], counts[i]) for i in order if counts[i]]
+    print_top('mnemonic', rows, int(counts.sum()), args.top)
+
+
+def hot_bb(args, meta):
+    # A basic block starts wherever the PC does not advance by 1 to
+    # --max-insn-size bytes (the same PC again is the next micro-op)
+    keys, counts, sizes = [], [], []
+    prev_pc, start_pc = None, None
+    for chunk in iter_chunks(args.tracedir, meta, ['pc', 'kernel']):
+        pc = np.asarray(chunk['pc']).astype(np.int64)
+        if not len(pc):
+            continue
+        delta = np.diff(pc, prepend=pc[0] if prev_pc is None else prev_pc)
+        starts = (delta < 0) | (delta > args.max_insn_size)
+        if prev_pc is None:
+            starts[0] = True
+
+        # Instructions of each block, the first one may continue the last
+        # block of the previous chunk
+        idx = np.flatnonzero(starts)
+        block_pc = pc[idx]
+        block_len = np.diff(np.append(idx, len(pc)))
+        block_new = np.ones(len(idx), np.int64)
+        if not starts[0]:
+            block_pc = np.insert(block_pc, 0, start_pc)
+            block_len = np.insert(block_len, 0, idx[0] if len(idx)
+                                  else len(pc))
+            block_new = np.insert(block_new, 0, 0)
+
+        if args.space != 'all':
+            kernel = block_pc.astype(np.uint64) >= np.uint64(KERNEL_PC)
+            keep = kernel if args.space == 'kernel' else ~kernel
+        else:
+            keep = slice(None)
+        keys.append(block_pc[keep])
+        counts.append(block_new[keep])
+        sizes.append(block_len[keep])
+        prev_pc, start_pc = pc[-1], block_pc[-1]
+
+    pcs, execs = merge_counts(keys, counts)
+    _, insts = merge_counts(keys, sizes)
+    order = np.argsort(-insts, kind='stable')
+    total = int(insts.sum())
+    print('%-24s %14s %14s %8s' % ('block', 'execs', 'insts', '%'))
+    for i in order[:args.top]:
+        print('%-24s %14d %14d %7.2f%%' % (
+            '0x%x' % (int(pcs[i]) & (2**64 - 1)), execs[i], insts[i],
+            100 * insts[i] / max(total, 1)))
+    print('%-24s %14s %14d' % ('total', '', total))
+
+
+def main():
+    args = parser.parse_args()
+    if args.action == 'convert':
+        convert(args)
+        return
+    meta = load_meta(args.tracedir)
+    {'pc-hist': pc_hist, 'mix': mix, 'hot-bb': hot_bb}[args.action](
+        args, meta)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from simpoint_utils import (
+    parse_size, host_jobs, gem5_command, log_contains, run_gem5)
+from m5stats import StatsFile
+import result_cache
+
+
+# Boot Linux once per kernel and disk image, then run every benchmark script
+# from the boot checkpoint. /root/init.sh in the image takes the checkpoint
+# with `m5 checkpoint` and runs whatever `m5 readfile` returns, i.e. the
+# --script of each restore (see README.md).
+
+EXIT_MSG = 'because m5_exit instruction encountered'
+BOOT_META = 'boot.json'
+
+
+######################################
+#          Argument Parsing          #
+######################################
+
+parser = argparse.ArgumentParser(
+    usage='%(prog)s [options] script [script ...] -- [restore options]')
+parser.add_argument('scripts', nargs='+',
+                    help='benchmark scripts, e.g. run-hello.sh')
+parser.add_argument('--gem5', default='build/RISCV/gem5.opt')
+parser.add_argument('--config',
+                    default='configs/example/riscv/fs_linux.py')
+parser.add_argument('--kernel', required=True)
+parser.add_argument('--disk-image', required=True)
+parser.add_argument('-B', '--boot-option', action='append', default=[],
+                    help='option of both boot and restores, e.g. --mem-size')
+parser.add_argument('--boot-cache', default='fs_boot_cache')
+parser.add_argument('-d', '--outdir', default='m5out/fs')
+parser.add_argument('-j', '--jobs', type=int)
+parser.add_argument('--mem-per-job', default='2GB')
+parser.add_argument('--retries', type=int, default=1)
+parser.add_argument('-f', '--force', action='store_true')
+parser.add_argument('--cpu', default='system.switch_cpus')
+parser.add_argument('-s', '--stat', action='append', default=[])
+parser.add_argument('--json')
+
+
+def parse_args(argv):
+    # Everything after '--' is passed to the restores as is
+    if '--' in argv:
+        i = argv.index('--')
+        argv, restore_args = argv[:i], argv[i + 1:]
+    else:
+        restore_args = []
+    args = parser.parse_args(argv)
+    args.restore_args = restore_args
+    return args
+
+
+def exited(outdir):
+    return log_contains(outdir, EXIT_MSG)
+
+
+def fs_args(args):
+    return ['--kernel=' + os.path.abspath(args.kernel),
+            '--disk-image=' + os.path.abspath(args.disk_image)] + \
+        args.boot_option
+
+
+#######################################
+#                 Boot                #
+#######################################
+
+
+def cached_digest(path, cache):
+    # Hashing a disk image takes a while, remember digests by size and mtime
+    st = os.stat(path)
+    key = '%s:%d:%d' % (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if key not in cache:
+        cache[key] = result_cache.file_digest(path)
+    return cache[key]
+
+
+def boot_key(args):
+    os.makedirs(args.boot_cache, exist_ok=True)
+    digests = os.path.join(args.boot_cache, 'digests.json')
+    try:
+        with open(digests) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        cache = {}
+    gem5 = os.path.realpath(args.gem5)
+    gem5_stat = os.stat(gem5)
+    key = result_cache.run_key(
+        kernel=cached_digest(args.kernel, cache),
+        disk_image=cached_digest(args.disk_image, cache),
+        config=[os.path.basename(args.config),
+                cached_digest(args.config, cache)],
+        options=args.boot_option,
+        gem5=[gem5, gem5_stat.st_size, gem5_stat.st_mtime_ns])
+    tmp = '%s.tmp.%d' % (digests, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp, digests)
+    return key
+
+
+def find_boot_checkpoint(boot_dir):
+    cpts = [name for name in os.listdir(boot_dir) if name.startswith('cpt.')]
+    if len(cpts) != 1:
+        return None
+    return os.path.join(boot_dir, cpts[0])
+
+
+def boot(args):
+    # Return the directory of the boot checkpoint, booting if not cached
+    key = boot_key(args)
+    boot_dir = os.path.join(args.boot_cache, key)
+    if os.path.exists(os.path.join(boot_dir, BOOT_META)):
+        print('Found boot checkpoint %s in %r' % (key[:12], args.boot_cache))
+        return boot_dir
+
+    # Without a --script, `m5 readfile` returns nothing and init.sh exits
+    # right after the checkpoint
+    tmp = '%s.tmp.%d' % (boot_dir, os.getpid())
+    print('Booting %s into %r' % (os.path.basename(args.kernel), tmp))
+    cmd = gem5_command(args.gem5, tmp, args.config, fs_args(args))
+    if not run_gem5(cmd, tmp, args.retries, exited) or \
+            find_boot_checkpoint(tmp) is None:
+        print('Booting failed, see %r' % os.path.join(tmp, 'gem5.log'))
+        exit(-1)
+    with open(os.path.join(tmp, BOOT_META), 'w') as f:
+        json.dump({'kernel': os.path.abspath(args.kernel),
+                   'disk_image': os.path.abspath(args.disk_image),
+                   'options': args.boot_option, 'argv': sys.argv}, f,
+                  indent=2)
+    try:
+        os.rename(tmp, boot_dir)
+    except OSError:
+        # Someone else booted the same system first
+        shutil.rmtree(tmp)
+    return boot_dir
+
+
+#######################################
+#               Restore               #
+#######################################
+
+
+def script_name(script):
+    name = os.path.splitext(os.path.basename(script))[0]
+    return name[len('run-'):] if name.startswith('run-') else name
+
+
+def run_scripts(args, boot_dir):
+    names = [script_name(script) for script in args.scripts]
+    if len(set(names)) < len(names):
+        parser.error('benchmark scripts must have distinct names.')
+    jobs = host_jobs(parse_size(args.mem_per_job), args.jobs)
+    print('Running %d benchmarks with %d jobs' % (len(names), jobs))
+
+    def run(script, outdir):
+        if not args.force and exited(outdir):
+            return True
+        cmd = gem5_command(
+            args.gem5, outdir, args.config,
+            fs_args(args) + ['--checkpoint-dir=' + os.path.abspath(boot_dir),
+                             '--checkpoint-restore=1',
+                             '--script=' + os.path.abspath(script)] +
+            args.restore_args)
+        return run_gem5(cmd, outdir, args.retries, exited)
+
+    results = {}
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = {pool.submit(run, script,
+                               os.path.join(args.outdir, name)): name
+                   for script, name in zip(args.scripts, names)}
+        for future in as_completed(futures):
+            results[futures[future]] = ok = future.result()
+            print('[%d/%d] %s %s' % (len(results), len(names),
+                                     futures[future],
+                                     'done' if ok else 'FAILED'))
+    return names, results
+
+
+def benchmark_result(outdir, cpu, stats=()):
+    # The first dump is the script's `m5 dumpstats` after `m5 resetstats`,
+    # the second one is gem5's own at exit
+    cycles, insts = cpu + '.numCycles', cpu + '.committedInsts'
+    try:
+        with StatsFile(os.path.join(outdir, 'stats.txt')) as sf:
+            dump = sf.dump(0, [cycles, insts] + list(stats))
+    except FileNotFoundError:
+        return None
+    if dump is None:
+        return None
+    result = {stat: dump.get(stat, float('nan')) for stat in stats}
+    if dump.get(insts) and cycles in dump:
+        result['cpi'] = dump[cycles] / dump[insts]
+    else:
+        result['cpi'] = float('nan')
+    return result
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    for path in [args.kernel, args.disk_image] + args.scripts:
+        if not os.path.isfile(path):
+            parser.error('%r not found.' % path)
+
+    boot_dir = boot(args)
+    names, ok = run_scripts(args, boot_dir)
+
+    results = {}
+    for name in names:
+        result = benchmark_result(os.path.join(args.outdir, name), args.cpu,
+                                  args.stat)
+        if result is not None:
+            results[name] = result
+
+    width = max([len(name) for name in names] + [len('benchmark')])
+    print('%-*s %10s' % (width, 'benchmark', 'cpi'),
+          *['%14s' % stat.split('.')[-1] for stat in args.stat])
+    for name in names:
+        if name not in results:
+            print('%-*s (no stats)' % (width, name))
+            continue
+        r = results[name]
+        print('%-*s %10.4f' % (width, name, r['cpi']),
+              *['%14.6g' % r[stat] for stat in args.stat])
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = [name for name in names if not ok[name]]
+    for name in failed:
+        print('Failed:', name)
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import json
+import time
+import atexit
+import resource
+import m5
+
+
+# Wrap m5.instantiate(), m5.simulate(), m5.checkpoint() and m5.switchCpus()
+# so that every call appends one JSON line with its host wall time, host CPU
+# time, simulated ticks and instructions, and peak RSS:
+#   {"seq": 3, "call": "simulate", "cause": "...", "wall": 12.3, ...}
+# The scripts look these functions up in m5 at call time, so install() only
+# has to run before the first of them.
+
+WRAPPED = ['instantiate', 'simulate', 'checkpoint', 'switchCpus']
+
+_out = None
+_seq = 0
+_t0 = None
+_instantiated = False
+
+
+def _host_cpu():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ru.ru_utime + ru.ru_stime
+
+
+def _max_rss():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _sim_insts():
+    # Sum over all CPUs, whether switched in or out
+    if not _instantiated:
+        return 0
+    root = m5.objects.Root.getInstance()
+    return sum(obj.totalInsts() for obj in root.descendants()
+               if isinstance(obj, m5.objects.BaseCPU))
+
+
+def _active_cpus():
+    # CPUs that are not switched out, i.e. that just simulated
+    root = m5.objects.Root.getInstance()
+    return [obj for obj in root.descendants()
+            if isinstance(obj, m5.objects.BaseCPU) and not obj.switchedOut()]
+
+
+def _describe(call, args, result):
+    if call == 'simulate':
+        cpus = _active_cpus()
+        info = {'cause': result.getCause(),
+                'cpus': [cpu.path() for cpu in cpus],
+                'cpu_types': sorted({cpu.type for cpu in cpus})}
+        if args:
+            info['limit'] = args[0]
+        return info
+    if call in ('instantiate', 'checkpoint') and args and args[0]:
+        return {'dir': args[0]}
+    if call == 'switchCpus' and len(args) > 1:
+        return {'switch': ['%s->%s' % (old.path(), new.path())
+                           for old, new in args[1]]}
+    return {}
+
+
+def record(call, **info):
+    global _seq
+    _seq += 1
+    info = dict(seq=_seq, call=call, time=time.time() - _t0,
+                maxrss_kb=_max_rss(), **info)
+    _out.write(json.dumps(info) + '\n')
+    _out.flush()
+
+
+def _wrap(call, func):
+    def wrapper(*args, **kwargs):
+        global _instantiated
+        tick, insts = m5.curTick(), _sim_insts()
+        wall, cpu = time.time(), _host_cpu()
+        result = func(*args, **kwargs)
+        wall, cpu = time.time() - wall, _host_cpu() - cpu
+        if call == 'instantiate':
+            _instantiated = True
+            tick, insts = m5.curTick(), _sim_insts()
+
+        info = _describe(call, args, result)
+        ticks = m5.curTick() - tick
+        insts = _sim_insts() - insts
+        record(call, wall=wall, host_cpu=cpu, tick=m5.curTick(),
+               ticks=ticks, insts=insts,
+               kips=insts / wall / 1000 if wall > 0 else None, **info)
+        return result
+    return wrapper
+
+
+def install(path):
+    # Installing again (e.g. in a forked child) starts a new timeline
+    global _out, _t0, _seq
+    if _out is not None:
+        _out.close()
+    else:
+        for call in WRAPPED:
+            setattr(m5, call, _wrap(call, getattr(m5, call)))
+        atexit.register(lambda: record('exit', host_cpu=_host_cpu()))
+    _out = open(path, 'w')
+    _t0 = time.time()
+    _seq = 0
@@ -0,0 +1,151 @@
+import os
+import json
+import mmap
+
+BEGIN_MARK = '---------- Begin Simulation Statistics ----------'
+END_MARK = '---------- End Simulation Statistics   ----------'
+
+
+def parse_value(s):
+    try:
+        return float(s)
+    except ValueError:
+        return None
+
+
+#######################################
+#          Indexed stats.txt          #
+#######################################
+
+# The index of stats.txt is cached in stats.txt.idx and rebuilt whenever the
+# size or mtime of stats.txt changes. It only covers the dumps read so far;
+# scanning resumes at "end" when a later dump is asked for:
+#   {"size": ..., "mtime_ns": ..., "end": ..., "complete": bool,
+#    "names": [name, ...],
+#    "dumps": [[offset of the line of names[i] or -1, ...], ...]}
+INDEX_SUFFIX = '.idx'
+
+
+def scan_dumps(f, offset, names, dumps, count=None):
+    # Index the dumps from offset on into names ({name: column}) and dumps,
+    # stopping once there are count dumps (all if None). Return the offset
+    # after the last indexed dump and whether the end of file was reached.
+    f.seek(offset)
+    end = offset
+    dump = None
+    for line in f:
+        if line.startswith(b'----------'):
+            if line.startswith(BEGIN_MARK.encode()):
+                dump = {}
+            elif line.startswith(END_MARK.encode()) and dump is not None:
+                offsets = [-1] * len(names)
+                for i, off in dump.items():
+                    offsets[i] = off
+                dumps.append(offsets)
+                dump = None
+                end = offset + len(line)
+                if count is not None and len(dumps) >= count:
+                    return end, False
+        elif dump is not None and line.strip():
+            name = line.split(None, 1)[0].decode(errors='replace')
+            dump[names.setdefault(name, len(names))] = offset
+        offset += len(line)
+    return end, True
+
+
+class StatsFile:
+    # Random access to any statistic of any dump in stats.txt. The file is
+    # scanned only up to the last dump asked for, indexing the offset of
+    # every line; later reads only touch the lines asked for through mmap.
+
+    def __init__(self, path):
+        self.path = path
+        st = os.stat(path)
+        self._stat = st.st_size, st.st_mtime_ns
+        index = None
+        try:
+            with open(path + INDEX_SUFFIX) as f:
+                index = json.load(f)
+            if (index['size'], index['mtime_ns']) != self._stat:
+                index = None
+        except (OSError, ValueError, KeyError):
+            index = None
+        if index is None:
+            index = {'end': 0, 'complete': False, 'names': [], 'dumps': []}
+
+        self.names = {name: i for i, name in enumerate(index['names'])}
+        self.dumps = index['dumps']
+        self._end = index['end']
+        self._complete = index['complete']
+        self._file = open(path, 'rb')
+        self._mm = None
+        if st.st_size:
+            self._mm = mmap.mmap(self._file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+    def _index(self, index):
+        # Extend the index to dump #index (to the end if negative)
+        if self._complete or 0 <= index < len(self.dumps):
+            return
+        self._end, self._complete = scan_dumps(
+            self._file, self._end, self.names, self.dumps,
+            index + 1 if index >= 0 else None)
+        # The index is only a cache, e.g. a read-only run dir is fine
+        idx = self.path + INDEX_SUFFIX
+        try:
+            tmp = '%s.tmp.%d' % (idx, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump({'size': self._stat[0], 'mtime_ns': self._stat[1],
+                           'end': self._end, 'complete': self._complete,
+                           'names': list(self.names), 'dumps': self.dumps},
+                          f)
+            os.replace(tmp, idx)
+        except OSError:
+            pass
+
+    def __len__(self):
+        self._index(-1)
+        return len(self.dumps)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+        self._file.close()
+
+    def get(self, name, index=-1):
+        # Value of name in dump #index, or None if it has no such stat
+        self._index(index)
+        try:
+            offset = self.dumps[index][self.names[name]]
+        except (IndexError, KeyError):
+            return None
+        if offset < 0:
+            return None
+        end = self._mm.find(b'\n', offset)
+        fields = self._mm[offset:end if end >= 0 else None].split(None, 2)
+        return parse_value(fields[1].decode()) if len(fields) > 1 else None
+
+    def dump(self, index=-1, names=None):
+        # {name: value} of the stats in names (all by default) in dump
+        # #index, None if there is no such dump
+        self._index(index)
+        if not -len(self.dumps) <= index < len(self.dumps):
+            return None
+        dump = {}
+        for name in self.names if names is None else names:
+            value = self.get(name, index)
+            if value is not None:
+                dump[name] = value
+        return dump
+
+    def delta(self, name, start, end=-1):
+        # Change of name from dump #start to dump #end, for stats that are
+        # not reset between the dumps
+        a, b = self.get(name, start), self.get(name, end)
+        return None if a is None or b is None else b - a
@@ -6,6 +6,7 @@ import m5
 from m5.objects import Cache, MemCtrl, SystemXBar, L2XBar, DDR3_1600_8x8, AddrRange
 from m5.objects import AtomicSimpleCPU, O3CPU
 from m5.objects import Process, Root, SEWorkload, System, SrcClockDomain, VoltageDomain
+from stat_sampler import StatSampler
 
 
 def print(*args):
@@ -118,6 +119,10 @@ system.cpu.createThreads()
 
 mode = 'repeat'
 
+# Statistics to sample at every slice into m5out/stats.samples, e.g.
+# ['system.switch_cpus0.ipc', 'system.cpu.dcache.overallMisses::total']
+sample_stats = []
+
 if mode == 'single':
     pass
 
@@ -144,6 +149,10 @@ elif mode == 'repeat':
     switch_freq = 10000000
     switch_cpu_list = [(system.cpu, system.switch_cpus[0])]
     last_tick = 0
+    sampler = None
+    if sample_stats:
+        sampler = StatSampler(
+            os.path.join(m5.options.outdir, 'stats.samples'), sample_stats)
 
     while True:
         switch_cpu_list[0][0].scheduleInstStop(0, 50000, 'slice')
@@ -157,6 +166,8 @@ elif mode == 'repeat':
         print('Execute with %s spent %d' % (switch_cpu_list[0][0], m5.curTick() - last_tick))
         print('Switch %s -> %s' % (switch_cpu_list[0]))
         last_tick = m5.curTick()
+        if sampler is not None:
+            sampler.sample()
 
         m5.switchCpus(system, switch_cpu_list)
 
@@ -166,4 +177,7 @@ elif mode == 'repeat':
         #    exit_event = m5.simulate(maxtick - m5.curTick())
         #    break
 
+    if sampler is not None:
+        sampler.close()
+
 print('Exiting @ tick %i because %s' % (m5.curTick(), exit_event.getCause()))
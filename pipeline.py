@@ -0,0 +1,354 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from simpoint_utils import (
+    find_anchors, find_checkpoints, is_complete, parse_size, host_cores,
+    host_mem_available, gem5_command)
+from simpoint_driver import profile_done, create_done, restore_done
+
+
+######################################
+#          Argument Parsing          #
+######################################
+
+parser = argparse.ArgumentParser(
+    description='Run profile -> cluster -> create -> restore -> aggregate '
+                'for every benchmark in a config file.')
+parser.add_argument('config', help='JSON config, see gem5_SimPoint.md')
+parser.add_argument('--cores', type=int, default=host_cores())
+parser.add_argument('--mem', help='memory budget (default: available)')
+parser.add_argument('--mem-reserve', default='2GB')
+parser.add_argument('--mem-per-job', default='2GB',
+                    help='RSS assumed for a stage never run before')
+parser.add_argument('--cluster-jobs', type=int, default=4)
+parser.add_argument('--retries', type=int, default=1)
+parser.add_argument('-f', '--force', action='store_true')
+parser.add_argument('-n', '--dry-run', action='store_true')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SPEC_SIMPOINT = os.path.join(HERE, 'spec_simpoint.py')
+
+# Hours of host time of each stage when there is no history, only used to
+# order jobs
+DEFAULT_HOURS = {'profile': 10, 'cluster': 0.1, 'create': 5, 'restore': 1,
+                 'aggregate': 0}
+
+
+#######################################
+#                 Jobs                #
+#######################################
+
+
+class Job:
+    def __init__(self, bench, stage, name, cmd, cwd, log, cores=1,
+                 deps=(), done=None, expand=None):
+        self.bench = bench
+        self.stage = stage
+        self.name = name
+        self.cmd = cmd
+        self.cwd = cwd
+        self.log = log
+        self.cores = cores
+        self.deps = list(deps)
+        self.done = done
+        self.expand = expand
+        self.attempts = 0
+        self.state = 'pending'
+
+
+class Benchmark:
+    # Paths and commands of one benchmark. Its outdir is the cpt_dir of
+    # spec_simpoint.py, which keeps simpoints.txt and all checkpoints.
+    def __init__(self, name, config, defaults):
+        self.name = name
+        self.gem5 = os.path.abspath(config.get('gem5', defaults['gem5']))
+        self.outdir = os.path.abspath(os.path.join(
+            defaults.get('outdir', 'spec'), name))
+        self.cwd = os.path.abspath(config.get('cwd', '.'))
+        self.spec_args = list(config['args'])
+        self.interval = config.get('interval', defaults.get('interval'))
+        self.warmup = config.get('warmup', defaults.get('warmup'))
+        self.anchor_interval = config.get(
+            'anchor_interval', defaults.get('anchor_interval'))
+        self.logdir = os.path.join(self.outdir, 'logs')
+
+    def options(self):
+        opts = []
+        if self.interval is not None:
+            opts += ['--interval', str(self.interval)]
+        if self.warmup is not None:
+            opts += ['--warmup', str(self.warmup)]
+        return opts
+
+    def gem5_job(self, stage, name, outdir, spec_args, deps=(), done=None,
+                 expand=None):
+        cmd = gem5_command(self.gem5, outdir, SPEC_SIMPOINT,
+                           spec_args + self.spec_args)
+        return Job(self, stage, name, cmd, self.cwd,
+                   os.path.join(outdir, 'gem5.log'), deps=deps, done=done,
+                   expand=expand)
+
+    def profile(self):
+        spec_args = ['profile'] + self.options()
+        if self.anchor_interval is not None:
+            spec_args += ['--anchor-interval', str(self.anchor_interval)]
+        return self.gem5_job(
+            'profile', 'profile', self.outdir, spec_args,
+            done=lambda: profile_done(self.outdir))
+
+    def cluster(self, args):
+        cmd = [sys.executable, os.path.join(HERE, 'simpoint_cluster.py'),
+               os.path.join(self.outdir, 'simpoint.bb.gz'),
+               '-o', self.outdir, '-j', str(args.cluster_jobs)]
+        return Job(self, 'cluster', 'cluster', cmd, self.outdir,
+                   os.path.join(self.logdir, 'cluster.log'),
+                   cores=args.cluster_jobs, deps=['profile'],
+                   done=lambda: os.path.exists(
+                       os.path.join(self.outdir, 'weights.txt')),
+                   expand=self.creates)
+
+    def creates(self):
+        # One job per gap between anchors, as simpoint_driver.py create. Each
+        # expands to the restores of its own checkpoints as soon as it ends.
+        bounds = [0] + [insts for insts, _ in find_anchors(self.outdir)]
+        aggregate = self.aggregate()
+        jobs = []
+        for lo, hi in zip(bounds, bounds[1:] + [None]):
+            outdir = os.path.join(self.outdir, 'create', 'insts_%d' % lo)
+            spec_args = ['create', '--cpt-dir', self.outdir,
+                         '--insts-range',
+                         '%d:%s' % (lo, '' if hi is None else hi)] + \
+                self.options()
+            jobs.append(self.gem5_job(
+                'create', 'create.insts_%d' % lo, outdir, spec_args,
+                deps=['cluster'],
+                done=lambda outdir=outdir: create_done(outdir),
+                expand=lambda lo=lo, hi=hi: self.restores(lo, hi,
+                                                          aggregate)))
+        aggregate.deps = [job.name for job in jobs]
+        return jobs + [aggregate]
+
+    def restores(self, lo, hi, aggregate):
+        # Checkpoints start in [lo, hi) as in spec_simpoint.py --insts-range
+        jobs = []
+        for cpt in find_checkpoints(self.outdir):
+            start = cpt.insts - cpt.warmup
+            if start < lo or (hi is not None and start >= hi) or \
+                    not is_complete(cpt.path):
+                continue
+            outdir = os.path.join(self.outdir, 'restore', cpt.name)
+            spec_args = ['restore', '-r', cpt.path,
+                         '--interval', str(cpt.interval),
+                         '--warmup', str(cpt.warmup)]
+            job = self.gem5_job(
+                'restore', 'restore.' + cpt.name, outdir, spec_args,
+                deps=['create.insts_%d' % lo],
+                done=lambda outdir=outdir: restore_done(outdir))
+            # Longer warmup plus interval runs longer
+            job.size = cpt.warmup + cpt.interval
+            jobs.append(job)
+        aggregate.deps += [job.name for job in jobs]
+        return jobs
+
+    def aggregate(self):
+        # Its deps grow as the create jobs expand to restores
+        cmd = [sys.executable, os.path.join(HERE, 'simpoint_driver.py'),
+               'aggregate', '-c', self.outdir,
+               '-d', os.path.join(self.outdir, 'restore'),
+               '--json', os.path.join(self.outdir, 'result.json')]
+        return Job(self, 'aggregate', 'aggregate', cmd, self.outdir,
+                   os.path.join(self.logdir, 'aggregate.log'), cores=0)
+
+
+#######################################
+#              Scheduling             #
+#######################################
+
+
+class History:
+    # Peak RSS and wall time of finished jobs, to estimate the next ones:
+    #   {"<bench>/<job name>": {"rss": bytes, "wall": seconds}, ...}
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.jobs = json.load(f)
+        except FileNotFoundError:
+            self.jobs = {}
+
+    def key(self, job):
+        return '%s/%s' % (job.bench.name, job.name)
+
+    def stage(self, job, field):
+        # Same job, else the largest among jobs of the same stage
+        if self.key(job) in self.jobs:
+            return self.jobs[self.key(job)][field]
+        prefix = '%s/%s' % (job.bench.name, job.stage)
+        values = [v[field] for k, v in self.jobs.items()
+                  if k.startswith(prefix)]
+        if not values:
+            values = [v[field] for k, v in self.jobs.items()
+                      if k.split('/', 1)[1].startswith(job.stage)]
+        return max(values) if values else None
+
+    def record(self, job, rss, wall):
+        self.jobs[self.key(job)] = {'rss': rss, 'wall': wall}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.jobs, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+def estimate_rss(job, history, default):
+    if job.stage == 'aggregate':
+        return 0
+    rss = history.stage(job, 'rss')
+    return int(rss * 1.1) if rss is not None else default
+
+
+def estimate_wall(job, history):
+    wall = history.stage(job, 'wall')
+    if wall is None:
+        wall = DEFAULT_HOURS[job.stage] * 3600
+    return wall, getattr(job, 'size', 0)
+
+
+def start(job):
+    os.makedirs(os.path.dirname(job.log), exist_ok=True)
+    with open(job.log, 'w') as f:
+        f.write('# %s\n' % ' '.join(job.cmd))
+        f.flush()
+        p = subprocess.Popen(job.cmd, cwd=job.cwd, stdout=f,
+                             stderr=subprocess.STDOUT)
+    job.attempts += 1
+    job.state = 'running'
+    job.started = time.time()
+    return p
+
+
+def run(args, jobs):
+    budget = parse_size(args.mem) if args.mem else \
+        host_mem_available() - parse_size(args.mem_reserve)
+    default_rss = parse_size(args.mem_per_job)
+    history = History(os.path.join(
+        os.path.dirname(jobs[0].bench.outdir), 'pipeline_history.json'))
+    print('Scheduling on %d cores with %d MB of memory'
+          % (args.cores, budget >> 20))
+
+    jobs = {(job.bench.name, job.name): job for job in jobs}
+    running = {}  # pid -> (job, estimated rss, Popen)
+
+    def add(new_jobs):
+        for job in new_jobs:
+            jobs[(job.bench.name, job.name)] = job
+
+    def dep_states(job):
+        return [jobs[(job.bench.name, dep)].state for dep in job.deps
+                if (job.bench.name, dep) in jobs]
+
+    while True:
+        # Skip finished jobs, and jobs whose dependency failed
+        changed = True
+        while changed:
+            changed = False
+            for job in list(jobs.values()):
+                if job.state != 'pending':
+                    continue
+                states = dep_states(job)
+                if any(s in ('failed', 'skipped') for s in states):
+                    job.state = 'skipped'
+                    changed = True
+                elif all(s == 'done' for s in states) and not args.force \
+                        and job.done is not None and job.done():
+                    job.state = 'done'
+                    changed = True
+                    if job.expand is not None:
+                        add(job.expand())
+
+        ready = [job for job in jobs.values() if job.state == 'pending'
+                 and all(s == 'done' for s in dep_states(job))]
+        # Longest first, so that the longest jobs do not finish last
+        ready.sort(key=lambda j: estimate_wall(j, history), reverse=True)
+
+        used_cores = sum(job.cores for job, _, _ in running.values())
+        used_mem = sum(rss for _, rss, _ in running.values())
+        for job in ready:
+            rss = estimate_rss(job, history, default_rss)
+            # Smaller jobs may fill in while a large one does not fit, but
+            # something always runs
+            if running and (used_cores + job.cores > args.cores
+                            or used_mem + rss > budget):
+                continue
+            print('Starting %s/%s (%d MB expected)'
+                  % (job.bench.name, job.name, rss >> 20))
+            if args.dry_run:
+                print('  ' + ' '.join(job.cmd))
+                job.state = 'done'
+                # Lists the jobs known from what is on disk so far
+                if job.expand is not None:
+                    add(job.expand())
+                continue
+            p = start(job)
+            running[p.pid] = job, rss, p
+            used_cores += job.cores
+            used_mem += rss
+
+        if not running:
+            if args.dry_run and ready:
+                continue
+            break
+
+        # Reap children with os.wait4() for their peak RSS; the Popen objects
+        # are kept so that subprocess does not reap them first
+        pid, status, rusage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+        job, _, p = running.pop(pid)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.time() - job.started
+        ok = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0 \
+            and (job.done is None or job.done())
+        if ok:
+            # ru_maxrss is in kB on Linux. Failed runs may have died early
+            # and are not representative.
+            history.record(job, rusage.ru_maxrss * 1024, wall)
+            job.state = 'done'
+            if job.expand is not None:
+                add(job.expand())
+        elif job.attempts <= args.retries:
+            os.replace(job.log, '%s.%d' % (job.log, job.attempts))
+            job.state = 'pending'
+        else:
+            job.state = 'failed'
+        print('%s %s/%s in %.0fs, %d MB peak RSS'
+              % ('Finished' if ok else 'FAILED', job.bench.name, job.name,
+                 wall, rusage.ru_maxrss >> 10))
+
+    failed = [job for job in jobs.values()
+              if job.state in ('failed', 'skipped')]
+    for job in failed:
+        print('%s: %s/%s' % (job.state.capitalize(), job.bench.name, job.name))
+    return failed
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = json.load(f)
+    defaults = {k: v for k, v in config.items() if k != 'benchmarks'}
+    defaults.setdefault('gem5', 'build/RISCV/gem5.opt')
+
+    jobs = []
+    for name, bench_config in config['benchmarks'].items():
+        bench = Benchmark(name, bench_config, defaults)
+        os.makedirs(bench.outdir, exist_ok=True)
+        jobs += [bench.profile(), bench.cluster(args)]
+    failed = run(args, jobs)
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
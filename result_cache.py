@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+
+# Files of a finished run kept in the cache
+RESULT_FILES = ['stats.txt', 'config.ini', 'config.json', 'rate.json']
+META = 'meta.json'
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def run_key(**parts):
+    # parts must be JSON serializable, e.g. binary digest, checkpoint id,
+    # config.ini text and gem5 build
+    text = json.dumps(parts, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def lookup(cache_dir, key, outdir):
+    # Copy a cached result into outdir, return whether it was found
+    entry = entry_dir(cache_dir, key)
+    if not os.path.exists(os.path.join(entry, META)):
+        return False
+    for fn in os.listdir(entry):
+        if fn != META:
+            shutil.copyfile(os.path.join(entry, fn), os.path.join(outdir, fn))
+    # mtime of META is the last use, for LRU eviction
+    os.utime(os.path.join(entry, META))
+    return True
+
+
+def store(cache_dir, key, outdir, meta, max_bytes=None):
+    entry = entry_dir(cache_dir, key)
+    tmp = '%s.tmp.%d' % (entry, os.getpid())
+    os.makedirs(tmp)
+    for fn in RESULT_FILES:
+        if os.path.exists(os.path.join(outdir, fn)):
+            shutil.copyfile(os.path.join(outdir, fn), os.path.join(tmp, fn))
+    with open(os.path.join(tmp, META), 'w') as f:
+        json.dump(dict(meta, key=key, time=time.time()), f, indent=2)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # Someone else stored the same result first
+        shutil.rmtree(tmp)
+    if max_bytes is not None:
+        evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir, max_bytes):
+    # Remove least recently used entries until the cache fits in max_bytes
+    entries = []
+    total = 0
+    for sub in os.listdir(cache_dir):
+        subdir = os.path.join(cache_dir, sub)
+        if not os.path.isdir(subdir):
+            continue
+        for key in os.listdir(subdir):
+            entry = os.path.join(subdir, key)
+            try:
+                used = os.stat(os.path.join(entry, META)).st_mtime
+                size = sum(os.stat(os.path.join(entry, fn)).st_size
+                           for fn in os.listdir(entry))
+            except OSError:
+                continue
+            entries.append((used, size, entry))
+            total += size
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
@@ -0,0 +1,207 @@
+import m5
+from m5.SimObject import SimObjectVector
+from m5.objects import (
+    System, SrcClockDomain, VoltageDomain,
+    Cache, SystemXBar, L2XBar, MemCtrl, AddrRange, DDR3_1600_8x8,
+    AtomicSimpleCPU, SEWorkload, Process)
+
+
+#######################################
+#          Cache Definitions          #
+#######################################
+
+
+class L1Cache(Cache):
+    assoc = 2
+    tag_latency = 2
+    data_latency = 2
+    response_latency = 2
+    mshrs = 4
+    tgts_per_mshr = 20
+
+
+class L1ICache(L1Cache):
+    size = '16kB'
+
+
+class L1DCache(L1Cache):
+    size = '64kB'
+
+
+class L2Cache(Cache):
+    size = '256kB'
+    assoc = 8
+    tag_latency = 20
+    data_latency = 20
+    response_latency = 20
+    mshrs = 20
+    tgts_per_mshr = 12
+
+
+class PageTableWalkerCache(Cache):
+    assoc = 2
+    tag_latency = 2
+    data_latency = 2
+    response_latency = 2
+    mshrs = 10
+    size = '1kB'
+    tgts_per_mshr = 12
+
+
+#######################################
+#         System Configuration        #
+#######################################
+
+
+def connect_cpu(system, cpu, caches):
+    if caches:
+        cpu.icache = L1ICache()
+        cpu.dcache = L1DCache()
+
+        cpu.icache.cpu_side = cpu.icache_port
+        cpu.dcache.cpu_side = cpu.dcache_port
+
+        cpu.icache.mem_side = system.l2bus.cpu_side_ports
+        cpu.dcache.mem_side = system.l2bus.cpu_side_ports
+
+        # TLB walker caches are necessary to x86 and riscv
+        if m5.defines.buildEnv['TARGET_ISA'] in ['x86', 'riscv']:
+            cpu.itb_walker_cache = PageTableWalkerCache()
+            cpu.dtb_walker_cache = PageTableWalkerCache()
+            cpu.mmu.connectWalkerPorts(
+                cpu.itb_walker_cache.cpu_side,
+                cpu.dtb_walker_cache.cpu_side)
+
+            cpu.itb_walker_cache.mem_side = system.l2bus.cpu_side_ports
+            cpu.dtb_walker_cache.mem_side = system.l2bus.cpu_side_ports
+
+    else:
+        cpu.icache_port = system.membus.cpu_side_ports
+        cpu.dcache_port = system.membus.cpu_side_ports
+
+    cpu.createInterruptController()
+
+    # For x86 only, make sure the interrupts are connected to the memory
+    # Note: these are directly connected to the memory bus and are not cached
+    if m5.defines.buildEnv['TARGET_ISA'] == "x86":
+        cpu.interrupts[0].pio = system.membus.mem_side_ports
+        cpu.interrupts[0].int_requestor = system.membus.cpu_side_ports
+        cpu.interrupts[0].int_responder = system.membus.mem_side_ports
+
+
+def build_system(binary, options=(), caches=False, mem_size='8GB',
+                 clock='2GHz', input=None, output=None, errout=None,
+                 cores=1):
+    # With cores > 1 (rate mode), system.cpu is a vector of CPUs each
+    # running its own copy of the program, with private L1 and walker
+    # caches and a shared L2. One core keeps the names of older checkpoints.
+    system = System()
+
+    system.clk_domain = SrcClockDomain()
+    system.clk_domain.clock = clock
+    system.clk_domain.voltage_domain = VoltageDomain()
+
+    system.mem_mode = 'atomic'
+    system.mem_ranges = [AddrRange(mem_size)]
+
+    if cores == 1:
+        system.cpu = AtomicSimpleCPU()
+    else:
+        system.cpu = [AtomicSimpleCPU(cpu_id=i) for i in range(cores)]
+
+    system.membus = SystemXBar()
+
+    if caches:
+        system.l2bus = L2XBar()
+        system.l2cache = L2Cache()
+        system.l2cache.cpu_side = system.l2bus.mem_side_ports
+        system.l2cache.mem_side = system.membus.cpu_side_ports
+
+    for cpu in as_list(system.cpu):
+        connect_cpu(system, cpu, caches)
+
+    system.mem_ctrl = MemCtrl()
+    system.mem_ctrl.dram = DDR3_1600_8x8()
+    system.mem_ctrl.dram.range = system.mem_ranges[0]
+    system.mem_ctrl.port = system.membus.mem_side_ports
+
+    system.system_port = system.membus.cpu_side_ports
+
+    system.workload = SEWorkload.init_compatible(binary)
+
+    for i, cpu in enumerate(as_list(system.cpu)):
+        # Every copy needs its own pid, and its own output files
+        suffix = '' if cores == 1 else '.%d' % i
+        process = Process(pid=100 + i)
+        process.cmd = [binary] + list(options)
+        if input is not None:
+            process.input = input
+        if output is not None:
+            process.output = output + suffix
+        if errout is not None:
+            process.errout = errout + suffix
+
+        cpu.workload = process
+        cpu.createThreads()
+
+    return system
+
+
+def as_list(obj):
+    # system.cpu, system.switch_cpu or any per-core object as a list,
+    # whatever the core count
+    return list(obj) if isinstance(obj, SimObjectVector) else [obj]
+
+
+def add_switch_cpu(system, cpu_type):
+    # The switch CPU should copy key settings from the original cpu
+    cpu_class = getattr(m5.objects, cpu_type)
+
+    switch_cpus = []
+    for i, cpu in enumerate(as_list(system.cpu)):
+        switch_cpu = cpu_class(switched_out=True, cpu_id=i)
+        switch_cpu.workload = cpu.workload
+        switch_cpu.clk_domain = cpu.clk_domain
+        switch_cpu.progress_interval = cpu.progress_interval
+        switch_cpu.isa = cpu.isa
+
+        switch_cpu.createThreads()
+        switch_cpus.append(switch_cpu)
+    system.switch_cpu = switch_cpus[0] if len(switch_cpus) == 1 \
+        else switch_cpus
+    return system.switch_cpu
+
+
+def switch_pairs(system, back=False):
+    # (old, new) pairs of m5.switchCpus() for every core
+    pairs = list(zip(as_list(system.cpu), as_list(system.switch_cpu)))
+    return [(new, old) for old, new in pairs] if back else pairs
+
+
+#######################################
+#           Parameter Override        #
+#######################################
+
+# Short names for the first component of a parameter path
+PARAM_ALIASES = {
+    'l1i': ['cpu.icache'],
+    'l1d': ['cpu.dcache'],
+    'l2': ['l2cache'],
+    'walker': ['cpu.itb_walker_cache', 'cpu.dtb_walker_cache'],
+    'clock': ['clk_domain.clock'],
+}
+
+
+def set_param(system, key, value):
+    # Set e.g. 'l2.size' or 'switch_cpu.numROBEntries' below system. The
+    # value is a string and converted by the parameter itself.
+    first, _, rest = key.partition('.')
+    for path in PARAM_ALIASES.get(first, [first]):
+        names = path.split('.') + (rest.split('.') if rest else [])
+        objs = [system]
+        for name in names[:-1]:
+            # Rate mode has a vector of each per-core object, set them all
+            objs = [child for obj in objs
+                    for child in as_list(getattr(obj, name))]
+        for obj in objs:
+            setattr(obj, names[-1], value)
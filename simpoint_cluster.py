@@ -0,0 +1,229 @@
+import os
+import gzip
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+######################################
+#          Argument Parsing          #
+######################################
+
+parser = argparse.ArgumentParser(
+    description='Pick SimPoints from a BBV file (simpoint.bb.gz).')
+parser.add_argument('bbv')
+parser.add_argument('-o', '--outdir')
+parser.add_argument('-k', '--max-k', type=int, default=30)
+parser.add_argument('--fixed-k', type=int)
+parser.add_argument('--dim', type=int, default=15)
+parser.add_argument('--init-tries', type=int, default=5)
+parser.add_argument('--iters', type=int, default=100)
+parser.add_argument('--bic-threshold', type=float, default=0.9)
+parser.add_argument('--seed', type=int, default=493575226)
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+
+
+#######################################
+#             BBV Loading             #
+#######################################
+
+
+def load_bbv(path, chunk_lines=4096):
+    # Each line starting with 'T' is one interval:
+    #   T:<bb id>:<count> :<bb id>:<count> ...
+    # Return a CSR matrix as (indptr, indices, data)
+    opener = gzip.open if path.endswith('.gz') else open
+    indptr, indices, data = [np.zeros(1, np.int64)], [], []
+    nnz = 0
+
+    def flush(lines):
+        nonlocal nnz
+        lens = np.array([len(l) for l in lines], np.int64) // 2
+        pairs = np.array([t for l in lines for t in l], np.int64)
+        indices.append(pairs[0::2])
+        data.append(pairs[1::2].astype(np.float64))
+        indptr.append(nnz + np.cumsum(lens))
+        nnz += int(lens.sum())
+
+    lines = []
+    with opener(path, 'rt') as f:
+        for line in f:
+            if line.startswith('T'):
+                lines.append(line[1:].replace(':', ' ').split())
+                if len(lines) == chunk_lines:
+                    flush(lines)
+                    lines = []
+    if lines:
+        flush(lines)
+
+    if not indices:
+        return indptr[0], np.zeros(0, np.int64), np.zeros(0)
+    return (np.concatenate(indptr), np.concatenate(indices),
+            np.concatenate(data))
+
+
+def project(indptr, indices, data, dim, rng, chunk_nnz=1 << 22):
+    # Normalize every BBV to sum 1, then reduce it to dim dimensions with a
+    # random projection, row chunks at a time to bound memory
+    n = len(indptr) - 1
+    proj = rng.uniform(-1, 1, (int(indices.max(initial=0)) + 1, dim))
+    sums = np.add.reduceat(data, indptr[:-1][np.diff(indptr) > 0]) \
+        if len(data) else np.zeros(0)
+    row_sum = np.zeros(n)
+    row_sum[np.diff(indptr) > 0] = sums
+
+    x = np.zeros((n, dim))
+    start = 0
+    while start < n:
+        stop = int(np.searchsorted(indptr, indptr[start] + chunk_nnz))
+        stop = min(max(stop, start + 1), n)
+        lo, hi = indptr[start], indptr[stop]
+        rows = np.arange(start, stop)
+        nonempty = rows[np.diff(indptr[start:stop + 1]) > 0]
+        if len(nonempty):
+            weighted = data[lo:hi, None] * proj[indices[lo:hi]]
+            x[nonempty] = np.add.reduceat(weighted, indptr[nonempty] - lo)
+        start = stop
+    x[row_sum > 0] /= row_sum[row_sum > 0, None]
+    return x
+
+
+#######################################
+#         k-means and BIC Score       #
+#######################################
+
+_x = None
+
+
+def _init_worker(x):
+    global _x
+    _x = x
+
+
+def assign(x, centers):
+    d2 = ((x * x).sum(1)[:, None] - 2 * x @ centers.T
+          + (centers * centers).sum(1)[None, :])
+    labels = d2.argmin(1)
+    return labels, np.maximum(d2[np.arange(len(x)), labels], 0)
+
+
+def kmeans(x, k, seed, iters):
+    rng = np.random.default_rng(seed)
+    n = len(x)
+
+    # k-means++ seeding
+    centers = np.empty((k, x.shape[1]))
+    centers[0] = x[rng.integers(n)]
+    d2 = ((x - centers[0]) ** 2).sum(1)
+    for i in range(1, k):
+        total = d2.sum()
+        c = rng.choice(n, p=d2 / total) if total > 0 else rng.integers(n)
+        centers[i] = x[c]
+        d2 = np.minimum(d2, ((x - centers[i]) ** 2).sum(1))
+
+    for _ in range(iters):
+        labels, d2 = assign(x, centers)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, x[:, j], k)
+                         for j in range(x.shape[1])], 1)
+        new = centers.copy()
+        new[counts > 0] = sums[counts > 0] / counts[counts > 0, None]
+        if np.allclose(new, centers):
+            break
+        centers = new
+    labels, d2 = assign(x, centers)
+    return labels, centers, d2
+
+
+def bic(x, labels, k, sse):
+    # BIC of a spherical Gaussian mixture (Pelleg & Moore, X-means), the
+    # same criterion SimPoint 3.2 uses to choose k
+    n, d = x.shape
+    if n <= k:
+        return -np.inf
+    var = max(sse / (d * (n - k)), 1e-300)
+    sizes = np.bincount(labels, minlength=k)
+    sizes = sizes[sizes > 0]
+    loglike = ((sizes * np.log(sizes / n)).sum()
+               - n * d / 2 * np.log(2 * np.pi * var) - d * (n - k) / 2)
+    params = (k - 1) + k * d + 1
+    return loglike - params / 2 * np.log(n)
+
+
+def cluster(task):
+    k, seeds, iters = task
+    best = None
+    for seed in seeds:
+        labels, centers, d2 = kmeans(_x, k, seed, iters)
+        if best is None or d2.sum() < best[2].sum():
+            best = labels, centers, d2
+    labels, centers, d2 = best
+    return k, labels, d2, bic(_x, labels, k, d2.sum())
+
+
+def pick_simpoints(labels, d2, k):
+    # One representative (closest to its centroid) per non-empty cluster
+    n = len(labels)
+    simpoints, weights = [], []
+    for c in range(k):
+        members = np.flatnonzero(labels == c)
+        if len(members):
+            simpoints.append((int(members[d2[members].argmin()]), c))
+            weights.append((len(members) / n, c))
+    return simpoints, weights
+
+
+def main():
+    args = parser.parse_args()
+    outdir = args.outdir or os.path.dirname(os.path.abspath(args.bbv))
+
+    print('Loading %r' % args.bbv)
+    indptr, indices, data = load_bbv(args.bbv)
+    n = len(indptr) - 1
+    if n == 0:
+        print('No interval found in %r' % args.bbv)
+        exit(-1)
+    print('Loaded %d intervals, %d basic blocks, %d non-zeros'
+          % (n, int(indices.max(initial=0)), len(data)))
+
+    rng = np.random.default_rng(args.seed)
+    x = project(indptr, indices, data, args.dim, rng)
+    del indptr, indices, data
+
+    if args.fixed_k is not None:
+        ks = [args.fixed_k]
+    else:
+        ks = list(range(1, min(args.max_k, n) + 1))
+    seeds = rng.integers(1 << 31, size=(len(ks), args.init_tries))
+    tasks = [(k, s.tolist(), args.iters) for k, s in zip(ks, seeds)]
+
+    # Larger k first so that the slowest tasks do not finish last
+    results = {}
+    with ProcessPoolExecutor(args.jobs, initializer=_init_worker,
+                             initargs=(x,)) as pool:
+        for k, labels, d2, score in pool.map(cluster, tasks[::-1]):
+            results[k] = labels, d2, score
+            print('k = %-3d BIC = %.6g' % (k, score))
+
+    scores = np.array([results[k][2] for k in ks])
+    lo, hi = scores.min(), scores.max()
+    k = next(k for k, s in zip(ks, scores)
+             if s >= lo + args.bic_threshold * (hi - lo))
+    labels, d2, _ = results[k]
+    simpoints, weights = pick_simpoints(labels, d2, k)
+    print('Picked k = %d with %d simpoints' % (k, len(simpoints)))
+
+    # Same format as SimPoint 3.2's -saveSimpoints and -saveSimpointWeights
+    spath = os.path.join(outdir, 'simpoints.txt')
+    wpath = os.path.join(outdir, 'weights.txt')
+    with open(spath, 'w') as f:
+        for s, c in simpoints:
+            f.write('%d %d\n' % (s, c))
+    with open(wpath, 'w') as f:
+        for w, c in weights:
+            f.write('%r %d\n' % (w, c))
+    print('Written %r and %r' % (spath, wpath))
+
+
+if __name__ == '__main__':
+    main()
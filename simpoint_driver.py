@@ -0,0 +1,536 @@
+import os
+import sys
+import json
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from simpoint_utils import (
+    parse_checkpoint, find_checkpoints, find_anchors, parse_size, host_jobs,
+    gem5_command, is_complete, log_contains, run_gem5, write_warmup)
+from m5stats import StatsFile
+import ckpt_store
+import work_queue
+
+
+PROFILE_DONE_MSG = 'Done profiling'
+DONE_MSG = 'Done running SimPoint'
+CREATE_DONE_MSG = 'Done creating checkpoints'
+
+# Jobs submitted at a time with --queue, the workers bound how many run
+QUEUE_JOBS = 256
+
+
+######################################
+#          Argument Parsing          #
+######################################
+
+parser = argparse.ArgumentParser(
+    usage='%(prog)s mode [options] -- [spec_simpoint.py options] '
+          'binary [binary options]')
+parser.add_argument('mode', choices=['create', 'restore', 'aggregate', 'sweep',
+                                     'calibrate'])
+parser.add_argument('--gem5', default='build/RISCV/gem5.opt')
+parser.add_argument('--script', default=os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'spec_simpoint.py'))
+parser.add_argument('-c', '--cpt-dir', default='m5out')
+parser.add_argument('-d', '--outdir')
+parser.add_argument('-j', '--jobs', type=int)
+parser.add_argument('--mem-per-job', default='2GB')
+parser.add_argument('--retries', type=int, default=1)
+parser.add_argument('-f', '--force', action='store_true')
+parser.add_argument('--cpu', default='system.switch_cpu')
+parser.add_argument('-s', '--stat', action='append', default=[])
+parser.add_argument('--json')
+parser.add_argument('--ckpt-store')
+parser.add_argument('--grid')
+parser.add_argument('--batch', action='store_true')
+parser.add_argument('--progressive', action='store_true')
+parser.add_argument('--coverage', type=float, default=0.99)
+parser.add_argument('--error', type=float, default=0.01)
+parser.add_argument('--min-runs', type=int, default=3)
+parser.add_argument('--samples', type=int, default=4)
+parser.add_argument('--steps', type=int, default=7)
+parser.add_argument('--tolerance', type=float, default=0.01)
+parser.add_argument('--queue')
+
+
+def parse_args(argv):
+    # Everything after '--' is passed to spec_simpoint.py as is
+    if '--' in argv:
+        i = argv.index('--')
+        argv, spec_args = argv[:i], argv[i + 1:]
+    else:
+        spec_args = []
+    args = parser.parse_args(argv)
+    args.spec_args = spec_args
+    if args.queue is not None and args.batch:
+        parser.error('--batch runs on this host only, not with --queue.')
+    if args.outdir is None:
+        mode = args.mode if args.mode in ['create', 'sweep', 'calibrate'] \
+            else 'restore'
+        args.outdir = os.path.join(args.cpt_dir, mode)
+    return args
+
+
+def pool_jobs(args):
+    if args.queue is not None:
+        return args.jobs or QUEUE_JOBS
+    return host_jobs(parse_size(args.mem_per_job), args.jobs)
+
+
+def run_command(args, cmd, outdir, done_msg):
+    # Run here, or with --queue on whichever worker claims the job
+    if args.queue is not None:
+        return work_queue.run(args.queue, cmd, outdir, done_msg,
+                              args.retries)
+    return run_gem5(cmd, outdir, args.retries,
+                    lambda d: log_contains(d, done_msg))
+
+
+#######################################
+#                Create               #
+#######################################
+
+
+def profile_done(outdir):
+    return log_contains(outdir, PROFILE_DONE_MSG)
+
+
+def create_done(outdir):
+    return log_contains(outdir, CREATE_DONE_MSG)
+
+
+def run_creates(args):
+    # One worker per gap between anchor checkpoints. Each worker restores
+    # the anchor at the start of its gap and creates only the checkpoints
+    # starting inside it, so no worker fast-forwards more than one gap.
+    bounds = [0] + [insts for insts, _ in find_anchors(args.cpt_dir)]
+    ranges = [(lo, '%d:%s' % (lo, hi))
+              for lo, hi in zip(bounds, bounds[1:] + [''])]
+    jobs = pool_jobs(args)
+    print('Creating checkpoints in %d ranges with %d jobs'
+          % (len(ranges), jobs))
+
+    def run(lo, insts_range):
+        outdir = os.path.join(args.outdir, 'insts_%d' % lo)
+        spec_args = ['create', '--cpt-dir', os.path.abspath(args.cpt_dir),
+                     '--insts-range', insts_range] + args.spec_args
+        cmd = gem5_command(args.gem5, outdir, args.script, spec_args)
+        return run_command(args, cmd, outdir, CREATE_DONE_MSG)
+
+    results = {}
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = {pool.submit(run, *r): r[1] for r in ranges}
+        for future in as_completed(futures):
+            results[futures[future]] = ok = future.result()
+            print('[%d/%d] insts range %s %s'
+                  % (len(results), len(ranges), futures[future],
+                     'done' if ok else 'FAILED'))
+    return results
+
+
+#######################################
+#               Restore               #
+#######################################
+
+
+def restore_done(outdir):
+    return log_contains(outdir, DONE_MSG)
+
+
+def restore_command(args, cpt, outdir, extra=()):
+    # The interval and warmup must match the ones used to create cpt
+    spec_args = ['restore', '-r', os.path.abspath(cpt.path),
+                 '--interval', str(cpt.interval),
+                 '--warmup', str(cpt.warmup)]
+    if args.ckpt_store is not None:
+        spec_args += ['--ckpt-store', os.path.abspath(args.ckpt_store)]
+    spec_args += list(extra) + args.spec_args
+    return gem5_command(args.gem5, outdir, args.script, spec_args)
+
+
+def find_restorable(args):
+    cpts = [cpt for cpt in find_checkpoints(args.cpt_dir)
+            if is_complete(cpt.path)]
+    if args.ckpt_store is not None:
+        # Checkpoints only in the store are materialized by spec_simpoint.py
+        names = {cpt.name for cpt in cpts}
+        for name in ckpt_store.list_names(args.ckpt_store):
+            cpt = parse_checkpoint(os.path.join(args.cpt_dir, name))
+            if cpt is not None and name not in names:
+                cpts.append(cpt)
+        cpts.sort(key=lambda c: c.insts)
+    if not cpts:
+        print('No SimPoint checkpoint found in %r.' % args.cpt_dir,
+              'Have you run spec_simpoint.py create?')
+        exit(-1)
+    return cpts
+
+
+def run_restore(args, cpt, outdir, extra=()):
+    if not args.force and restore_done(outdir):
+        return True
+    cmd = restore_command(args, cpt, outdir, extra)
+    return run_command(args, cmd, outdir, DONE_MSG)
+
+
+def run_restores(args, tasks):
+    # tasks: [(checkpoint, outdir, extra spec_simpoint.py options), ...]
+    jobs = pool_jobs(args)
+    print('Running %d restores with %d jobs' % (len(tasks), jobs))
+
+    results = {}
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = {pool.submit(run_restore, args, *task): task[1]
+                   for task in tasks}
+        for future in as_completed(futures):
+            outdir = futures[future]
+            results[outdir] = ok = future.result()
+            print('[%d/%d] %s %s' % (len(results), len(tasks), outdir,
+                                     'done' if ok else 'FAILED'))
+    return results
+
+
+def run_batch(args, tasks):
+    # Restore all pending checkpoints in one gem5 process, which builds the
+    # system once and forks a child per checkpoint into outdir/<name>.
+    # Return the tasks that did not finish, to be run one by one.
+    pending = [task for task in tasks
+               if args.force or not restore_done(task[1])]
+    if not pending:
+        return []
+    jobs = host_jobs(parse_size(args.mem_per_job), args.jobs)
+    print('Running %d restores in one batch with %d jobs'
+          % (len(pending), jobs))
+    spec_args = ['restore', '-j', str(jobs)]
+    for cpt, _, _ in pending:
+        spec_args += ['-r', os.path.abspath(cpt.path)]
+    if args.ckpt_store is not None:
+        spec_args += ['--ckpt-store', os.path.abspath(args.ckpt_store)]
+    cmd = gem5_command(args.gem5, args.outdir, args.script,
+                       spec_args + args.spec_args)
+    run_gem5(cmd, args.outdir, log='batch.log')
+    return [task for task in pending if not restore_done(task[1])]
+
+
+def error_bound(done, total_weight):
+    # done: [(weight, cpi)] of finished runs. Assume the weight not covered
+    # yet has CPIs within the range seen so far, and bound how far the
+    # weighted CPI may move relative to the current estimate.
+    covered = sum(w for w, _ in done)
+    cpi = sum(w * c for w, c in done) / covered
+    lo, hi = min(c for _, c in done), max(c for _, c in done)
+    left = max(total_weight - covered, 0)
+    bound = left * max(cpi - lo, hi - cpi) / total_weight / cpi
+    return covered / total_weight, cpi, bound
+
+
+def run_progressive(args, tasks):
+    # Restore the heaviest checkpoints first and stop submitting once the
+    # covered weight reaches --coverage or the bound drops to --error
+    tasks = sorted(tasks, key=lambda t: t[0].weight, reverse=True)
+    total_weight = sum(cpt.weight for cpt, _, _ in tasks)
+    # Even with --queue, only keep as many restores in flight as this host
+    # would run, or submitting them all at once leaves nothing to stop
+    jobs = host_jobs(parse_size(args.mem_per_job), args.jobs)
+    print('Running up to %d restores by weight with %d jobs'
+          % (len(tasks), jobs))
+
+    results, done = {}, []
+    todo = iter(tasks)
+    stop = False
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = {}
+
+        def submit():
+            task = next(todo, None)
+            if task is not None:
+                futures[pool.submit(run_restore, args, *task)] = task
+
+        for _ in range(jobs):
+            submit()
+        while futures:
+            future = next(as_completed(futures))
+            cpt, outdir, _ = futures.pop(future)
+            results[outdir] = ok = future.result()
+            result = run_result(outdir, args.cpu) if ok else None
+            if result is not None:
+                done.append((cpt.weight, result[1]['cpi']))
+
+            if done:
+                coverage, cpi, bound = error_bound(done, total_weight)
+                print('[%d/%d] %s %s, covered %.2f%%, CPI %.4f +- %.2f%%'
+                      % (len(results), len(tasks), cpt.name,
+                         'done' if ok else 'FAILED', coverage * 100, cpi,
+                         bound * 100))
+                if not stop and len(done) >= args.min_runs and \
+                        (coverage >= args.coverage or bound <= args.error):
+                    stop = True
+                    print('Stopping after the running restores finish')
+            else:
+                print('[%d/%d] %s %s' % (len(results), len(tasks), cpt.name,
+                                         'done' if ok else 'FAILED'))
+            if not stop:
+                submit()
+
+    skipped = len(tasks) - len(results)
+    if skipped:
+        print('Skipped %d checkpoints with %.2f%% of the weight'
+              % (skipped, 100 * sum(cpt.weight for cpt, outdir, _ in tasks
+                                    if outdir not in results)
+                 / total_weight))
+    return results
+
+
+#######################################
+#              Aggregate              #
+#######################################
+
+
+def run_result(run_dir, cpu, stats=()):
+    # Return (checkpoint, {'cpi': ..., stat: ...}) of a restore run, or None
+    # if the run has not finished its measured interval
+    cpt = parse_checkpoint(run_dir)
+    if cpt is None:
+        return None
+    cycles, insts = cpu + '.numCycles', cpu + '.committedInsts'
+
+    # Restore mode dumps stats once after warmup (if any) and once at exit,
+    # the dump covering the measured interval is the one after warmup
+    index = 1 if cpt.warmup else 0
+    try:
+        with StatsFile(os.path.join(run_dir, 'stats.txt')) as sf:
+            dump = sf.dump(index, [cycles, insts] + list(stats))
+    except FileNotFoundError:
+        return None
+    # Rate mode measures each core over its own interval, the CPI is the
+    # mean over the cores
+    try:
+        with open(os.path.join(run_dir, 'rate.json')) as f:
+            rate = json.load(f)
+    except FileNotFoundError:
+        rate = None
+    if rate is None and (dump is None or not dump.get(insts)
+                         or cycles not in dump):
+        return None
+
+    dump = dump or {}
+    result = {'cpi': rate['cpi'] if rate else dump[cycles] / dump[insts]}
+    for stat in stats:
+        result[stat] = dump.get(stat, float('nan'))
+    return cpt, result
+
+
+def find_results(outroot, cpu, stats=()):
+    results = []
+    for name in sorted(os.listdir(outroot)):
+        result = run_result(os.path.join(outroot, name), cpu, stats)
+        if result is not None:
+            results.append(result)
+    results.sort(key=lambda r: r[0].insts)
+    return results
+
+
+def weighted_summary(results, stats=()):
+    # Weights are renormalized over the runs we have
+    weight = sum(cpt.weight for cpt, _ in results)
+    summary = {'weight': weight}
+    for key in ['cpi'] + list(stats):
+        summary[key] = sum(cpt.weight * r[key] for cpt, r in results) / weight
+    summary['ipc'] = 1 / summary['cpi']
+    return summary
+
+
+def print_results(results, summary, stats=()):
+    width = max([len(cpt.name) for cpt, _ in results] + [len('weighted')])
+    print('%-*s %10s %10s' % (width, 'checkpoint', 'weight', 'cpi'),
+          *['%14s' % stat.split('.')[-1] for stat in stats])
+    for cpt, r in results:
+        print('%-*s %10.6f %10.4f' % (width, cpt.name, cpt.weight, r['cpi']),
+              *['%14.6g' % r[stat] for stat in stats])
+    print('%-*s %10.6f %10.4f' % (width, 'weighted', summary['weight'],
+                                  summary['cpi']),
+          *['%14.6g' % summary[stat] for stat in stats])
+    print('Weighted IPC: %.4f' % summary['ipc'])
+
+
+def aggregate(args):
+    results = find_results(args.outdir, args.cpu, args.stat)
+    if not results:
+        print('No finished restore run found in %r.' % args.outdir)
+        exit(-1)
+    if os.path.isdir(args.cpt_dir):
+        missing = len(find_checkpoints(args.cpt_dir)) - len(results)
+        if missing > 0:
+            print('Warning: %d checkpoints have no finished run' % missing)
+
+    summary = weighted_summary(results, args.stat)
+    print_results(results, summary, args.stat)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            runs = {cpt.name: dict(r, weight=cpt.weight)
+                    for cpt, r in results}
+            json.dump({'runs': runs, 'weighted': summary}, f, indent=2)
+
+
+#######################################
+#                Sweep                #
+#######################################
+
+
+def sweep_points(grid):
+    # grid: {key: [values]}. Keys starting with '--' are spec_simpoint.py
+    # options (e.g. --switch-cpu), others are -P/--param overrides.
+    keys = sorted(grid)
+    for values in itertools.product(*(grid[k] for k in keys)):
+        name = ','.join('%s=%s' % (k.lstrip('-'), v)
+                        for k, v in zip(keys, values))
+        extra = []
+        for k, v in zip(keys, values):
+            extra += [k, str(v)] if k.startswith('--') \
+                else ['-P', '%s=%s' % (k, v)]
+        yield name.replace('/', '_'), extra
+
+
+def sweep(args):
+    if args.grid is None:
+        parser.error('sweep mode requires --grid.')
+    with open(args.grid) as f:
+        points = list(sweep_points(json.load(f)))
+
+    # Every configuration restores the same checkpoints, all in one pool
+    cpts = find_restorable(args)
+    tasks = [(cpt, os.path.join(args.outdir, name, cpt.name), extra)
+             for name, extra in points for cpt in cpts]
+    results = run_restores(args, tasks)
+    failed = [outdir for outdir, ok in results.items() if not ok]
+
+    summaries = {}
+    for name, _ in points:
+        results = find_results(os.path.join(args.outdir, name), args.cpu,
+                               args.stat)
+        if results:
+            summaries[name] = weighted_summary(results, args.stat)
+
+    width = max([len(name) for name in summaries] + [len('config')])
+    print('%-*s %8s %10s %10s' % (width, 'config', 'weight', 'cpi', 'ipc'),
+          *['%14s' % stat.split('.')[-1] for stat in args.stat])
+    for name, _ in points:
+        if name not in summaries:
+            print('%-*s (no finished run)' % (width, name))
+            continue
+        summary = summaries[name]
+        print('%-*s %8.4f %10.4f %10.4f' % (width, name, summary['weight'],
+                                            summary['cpi'], summary['ipc']),
+              *['%14.6g' % summary[stat] for stat in args.stat])
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(summaries, f, indent=2)
+    return failed
+
+
+#######################################
+#              Calibrate              #
+#######################################
+
+
+def warmup_ladder(warmup, steps):
+    # The full warmup halved steps - 1 times, longest first
+    return [warmup >> i for i in range(steps) if warmup >> i]
+
+
+def shortest_warmup(cpis, tolerance):
+    # cpis: [(warmup, cpi)] longest first. Return the shortest warmup whose
+    # CPI, and that of every longer warmup, is within tolerance of the CPI
+    # with the longest warmup
+    ref = cpis[0][1]
+    best = cpis[0][0]
+    for warmup, cpi in cpis:
+        if cpi is None or abs(cpi - ref) > tolerance * ref:
+            break
+        best = warmup
+    return best
+
+
+def calibrate(args):
+    # Restore the heaviest checkpoints with a ladder of warmups, the shorter
+    # ones skipping the start of the warmup the checkpoint was created with
+    cpts = [cpt for cpt in find_restorable(args) if cpt.warmup]
+    if not cpts:
+        print('No SimPoint checkpoint with a warmup found in %r.'
+              % args.cpt_dir)
+        exit(-1)
+    cpts = sorted(cpts, key=lambda c: c.weight, reverse=True)[:args.samples]
+
+    def run_dir(warmup, cpt):
+        return os.path.join(args.outdir, 'warmup_%d' % warmup, cpt.name)
+
+    tasks = [(cpt, run_dir(warmup, cpt),
+              ['--warmup-skip', str(cpt.warmup - warmup)])
+             for cpt in cpts
+             for warmup in warmup_ladder(cpt.warmup, args.steps)]
+    results = run_restores(args, tasks)
+    failed = [outdir for outdir, ok in results.items() if not ok]
+
+    calibrated = []
+    for cpt in cpts:
+        cpis = []
+        for warmup in warmup_ladder(cpt.warmup, args.steps):
+            result = run_result(run_dir(warmup, cpt), args.cpu)
+            cpis.append((warmup, result[1]['cpi'] if result else None))
+        if cpis[0][1] is None:
+            print('%s: no result with the full warmup' % cpt.name)
+            continue
+        best = shortest_warmup(cpis, args.tolerance)
+        calibrated.append(best)
+        print('%s: shortest warmup %d insts' % (cpt.name, best))
+        for warmup, cpi in cpis:
+            print('  %12d %s' % (warmup, 'FAILED' if cpi is None else
+                                 '%.4f %+.2f%%' % (
+                                     cpi, 100 * (cpi / cpis[0][1] - 1))))
+
+    if calibrated:
+        # The longest warmup any sampled checkpoint needs
+        warmup = max(calibrated)
+        write_warmup(args.cpt_dir, warmup)
+        print('Calibrated warmup: %d insts, written to %r'
+              % (warmup, args.cpt_dir))
+    return failed
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.mode == 'aggregate':
+        aggregate(args)
+        return
+    if not args.spec_args:
+        parser.error('spec_simpoint.py arguments are required after "--".')
+
+    if args.mode == 'create':
+        results = run_creates(args)
+        failed = [r for r, ok in results.items() if not ok]
+        for r in failed:
+            print('Failed: insts range', r)
+        exit(1 if failed else 0)
+
+    if args.mode == 'sweep':
+        failed = sweep(args)
+    elif args.mode == 'calibrate':
+        failed = calibrate(args)
+    else:
+        tasks = [(cpt, os.path.join(args.outdir, cpt.name), ())
+                 for cpt in find_restorable(args)]
+        if args.progressive:
+            results = run_progressive(args, tasks)
+        else:
+            if args.batch:
+                tasks = run_batch(args, tasks)
+            results = run_restores(args, tasks)
+        failed = [outdir for outdir, ok in results.items() if not ok]
+    for outdir in failed:
+        print('Failed:', outdir)
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+import os
+import re
+import gzip
+import shutil
+import struct
+import subprocess
+import collections
+
+
+# Checkpoints written by `spec_simpoint.py create`
+CKPT_RE = re.compile(
+    r'^cpt\.insts_(\d+)\.interval_(\d+)\.warmup_(\d+)\.weight_(.+)$')
+
+# Anchor checkpoints written by `spec_simpoint.py profile --anchor-interval`
+ANCHOR_RE = re.compile(r'^anchor\.insts_(\d+)$')
+
+# Sections of the CPUs, system.cpu0, system.cpu1, ... with several cores
+CPU_SECTION_RE = re.compile(r'^system\.cpu\d*$')
+
+# Written into a checkpoint directory after m5.checkpoint() returns
+COMPLETE_MARK = 'complete'
+
+# Warmup found by `simpoint_driver.py calibrate`, in the checkpoint directory
+WARMUP_FILE = 'warmup.txt'
+
+Checkpoint = collections.namedtuple(
+    'Checkpoint', ['name', 'path', 'insts', 'interval', 'warmup', 'weight'])
+
+SIZE_UNITS = {'': 1, 'B': 1, 'kB': 2**10, 'KB': 2**10, 'MB': 2**20,
+              'GB': 2**30, 'TB': 2**40}
+
+
+def parse_checkpoint(path):
+    name = os.path.basename(os.path.normpath(path))
+    m = CKPT_RE.match(name)
+    if m is None:
+        return None
+    insts, interval, warmup = map(int, m.group(1, 2, 3))
+    return Checkpoint(name, path, insts, interval, warmup, float(m.group(4)))
+
+
+def find_checkpoints(cpt_dir):
+    cpts = []
+    for name in os.listdir(cpt_dir):
+        cpt = parse_checkpoint(os.path.join(cpt_dir, name))
+        if cpt is not None and os.path.isdir(cpt.path):
+            cpts.append(cpt)
+    cpts.sort(key=lambda c: c.insts)
+    return cpts
+
+
+def find_anchors(cpt_dir):
+    anchors = []
+    for name in os.listdir(cpt_dir):
+        m = ANCHOR_RE.match(name)
+        path = os.path.join(cpt_dir, name)
+        if m is not None and os.path.isdir(path):
+            anchors.append((int(m.group(1)), path))
+    anchors.sort()
+    return anchors
+
+
+def read_stores(path):
+    # Return [(pmem filename, range_size), ...] recorded in path/m5.cpt
+    stores, filename = [], None
+    with open(os.path.join(path, 'm5.cpt'), errors='replace') as f:
+        for line in f:
+            if line.startswith('['):
+                filename = None
+            elif line.startswith('filename='):
+                filename = line.split('=', 1)[1].strip()
+            elif line.startswith('range_size=') and filename is not None:
+                stores.append((filename, int(line.split('=', 1)[1])))
+    return stores
+
+
+def pmem_size_ok(pmem, size):
+    # A gzipped store ends with the uncompressed size mod 2^32, which a
+    # truncated file is very unlikely to match. Raw stores are just sized.
+    with open(pmem, 'rb') as f:
+        if f.read(2) != b'\x1f\x8b':
+            return os.fstat(f.fileno()).st_size == size
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0] == size % 2**32
+
+
+def is_complete(path):
+    # Checkpoints without the mark (e.g. written by checkpoint.py or older
+    # versions of spec_simpoint.py) are verified against m5.cpt instead
+    if os.path.exists(os.path.join(path, COMPLETE_MARK)):
+        return True
+    try:
+        stores = read_stores(path)
+        return bool(stores) and all(
+            pmem_size_ok(os.path.join(path, pmem), size)
+            for pmem, size in stores)
+    except (OSError, ValueError, struct.error):
+        return False
+
+
+def mark_complete(path):
+    with open(os.path.join(path, COMPLETE_MARK), 'w'):
+        pass
+
+
+def read_warmup(cpt_dir):
+    try:
+        with open(os.path.join(cpt_dir, WARMUP_FILE)) as f:
+            return int(f.read().split()[0])
+    except FileNotFoundError:
+        return None
+
+
+def write_warmup(cpt_dir, warmup):
+    with open(os.path.join(cpt_dir, WARMUP_FILE), 'w') as f:
+        f.write('%d\n' % warmup)
+
+
+def read_sections(path):
+    # Return {section: {key: value}} of path/m5.cpt
+    sections, section = {}, None
+    with open(os.path.join(path, 'm5.cpt'), errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('[') and line.endswith(']'):
+                section = sections.setdefault(line[1:-1], {})
+            elif section is not None and '=' in line:
+                key, value = line.split('=', 1)
+                section[key] = value
+    return sections
+
+
+def checkpoint_cores(path):
+    # Number of cores checkpointed at path, more than one in rate mode
+    return max(1, sum(1 for name in read_sections(path)
+                      if CPU_SECTION_RE.match(name)))
+
+
+def read_mempools(path):
+    # SE mode allocates physical pages with a bump pointer per memory pool,
+    # every page below free_page_num may be in use
+    pools = []
+    for name, section in read_sections(path).items():
+        if 'free_page_num' in section and 'total_pages' in section:
+            pools.append((name, int(section['page_shift']),
+                          int(section['start_page']),
+                          int(section['free_page_num']),
+                          int(section['total_pages'])))
+    return pools
+
+
+def checkpoint_footprint(path):
+    # Bytes of physical memory used at path, or None if unknown
+    pools = read_mempools(path)
+    if not pools:
+        return None
+    return max(free << shift for _, shift, _, free, _ in pools)
+
+
+def resize_checkpoint(src, dst, mem_size, chunk_size=1 << 20):
+    # Copy checkpoint src to dst for a system with mem_size bytes of memory
+    # (gem5 refuses to restore into a memory of another size). The pmem is
+    # written as a sparse raw file, see ckpt_store.materialize().
+    stores = read_stores(src)
+    if len(stores) != 1:
+        raise ValueError('%r has %d memory stores' % (src, len(stores)))
+    footprint = checkpoint_footprint(src)
+    if footprint is None or footprint > mem_size:
+        raise ValueError('%r uses %s bytes of memory' % (src, footprint))
+    pmem, _ = stores[0]
+
+    tmp = os.path.normpath(dst) + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for fn in os.listdir(src):
+        if fn not in (pmem, 'm5.cpt', COMPLETE_MARK):
+            shutil.copy2(os.path.join(src, fn), os.path.join(tmp, fn))
+
+    pools = {name: (shift, start)
+             for name, shift, start, _, _ in read_mempools(src)}
+    section = None
+    with open(os.path.join(src, 'm5.cpt')) as fin, \
+            open(os.path.join(tmp, 'm5.cpt'), 'w') as fout:
+        for line in fin:
+            stripped = line.strip()
+            if stripped.startswith('[') and stripped.endswith(']'):
+                section = stripped[1:-1]
+            elif stripped.startswith('range_size='):
+                line = 'range_size=%d\n' % mem_size
+            elif stripped.startswith('total_pages=') and section in pools:
+                shift, start = pools[section]
+                line = 'total_pages=%d\n' % ((mem_size >> shift) - start)
+            fout.write(line)
+
+    # Pages at and above the footprint are zero, only copy below it
+    with open(os.path.join(src, pmem), 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    fin = gzip.open if gzipped else open
+    zero = bytes(chunk_size)
+    with fin(os.path.join(src, pmem), 'rb') as f, \
+            open(os.path.join(tmp, pmem), 'wb') as out:
+        left = footprint
+        while left > 0:
+            chunk = f.read(min(chunk_size, left))
+            if not chunk:
+                break
+            if chunk == zero[:len(chunk)]:
+                out.seek(len(chunk), os.SEEK_CUR)
+            else:
+                out.write(chunk)
+            left -= len(chunk)
+        out.truncate(mem_size)
+
+    mark_complete(tmp)
+    shutil.rmtree(dst, ignore_errors=True)
+    os.replace(tmp, dst)
+
+
+def parse_size(s):
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*$', str(s))
+    if m is None or m.group(2) not in SIZE_UNITS:
+        raise ValueError('invalid size %r' % s)
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2)])
+
+
+#######################################
+#            Host Resources           #
+#######################################
+
+
+def host_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def host_mem_available():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def host_jobs(mem_per_job, max_jobs=None):
+    jobs = min(host_cores(), max(1, host_mem_available() // mem_per_job))
+    if max_jobs is not None:
+        jobs = min(jobs, max_jobs)
+    return max(1, jobs)
+
+
+#######################################
+#              gem5 Runs              #
+#######################################
+
+
+def gem5_command(gem5, outdir, script, args):
+    return [gem5, '--outdir=' + outdir, script] + list(args)
+
+
+def log_contains(outdir, msg, log='gem5.log'):
+    try:
+        with open(os.path.join(outdir, log), errors='replace') as f:
+            return any(msg in line for line in f)
+    except FileNotFoundError:
+        return False
+
+
+def run_gem5(cmd, outdir, retries=0, done=None, log='gem5.log', cwd=None):
+    # Run cmd with its output logged into outdir. Logs of failed attempts
+    # are kept as gem5.log.<attempt>.
+    os.makedirs(outdir, exist_ok=True)
+    log = os.path.join(outdir, log)
+    for attempt in range(retries + 1):
+        with open(log, 'w') as f:
+            f.write('# %s\n' % ' '.join(cmd))
+            f.flush()
+            p = subprocess.run(cmd, stdout=f, stderr=subprocess.STDOUT,
+                               cwd=cwd)
+        if p.returncode == 0 and (done is None or done(outdir)):
+            return True
+        os.replace(log, '%s.%d' % (log, attempt))
+    return False
@@ -1,12 +1,26 @@
+import io
 import os
+import json
 import sys
+import shutil
 import argparse
 import builtins
+import threading
+from statistics import NormalDist
 import m5
-from m5.objects import (
-    System, SrcClockDomain, VoltageDomain,
-    Cache, SystemXBar, L2XBar, MemCtrl, AddrRange, DDR3_1600_8x8,
-    AtomicSimpleCPU, SEWorkload, Process, Root)
+import _m5.core
+import _m5.trace
+from m5.objects import Root
+from se_system import (
+    build_system, add_switch_cpu, set_param, as_list, switch_pairs)
+from simpoint_utils import (
+    find_anchors, find_checkpoints, is_complete, mark_complete, parse_size,
+    parse_checkpoint, read_stores, checkpoint_footprint, resize_checkpoint,
+    read_warmup, checkpoint_cores)
+import ckpt_store
+import result_cache
+import host_profile
+import telemetry
 
 
 def print(*args, **kwargs):
@@ -20,16 +34,53 @@ def print(*args, **kwargs):
 #          Argument Parsing          #
 ######################################
 
+
+def warmup_type(s):
+    # Instructions, or 'auto' for the calibrated warmup
+    if s == 'auto':
+        return s
+    try:
+        return int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected an integer or 'auto', got %r" % s)
+
+
 parser = argparse.ArgumentParser()
-parser.add_argument('mode', choices=['profile', 'create', 'restore'])
-parser.add_argument('-r', '--checkpoint-restore')
+parser.add_argument('mode',
+                    choices=['profile', 'create', 'restore', 'sample'])
+parser.add_argument('-r', '--checkpoint-restore', action='append')
 parser.add_argument('-I', '--maxinsts')
 parser.add_argument('-i', '--input')
 parser.add_argument('-o', '--output')
 parser.add_argument('-e', '--errout')
 parser.add_argument('--interval', type=int, default=10**8)
-parser.add_argument('--warmup', type=int, default=10**7)
+parser.add_argument('--warmup', type=warmup_type, default=10**7)
+parser.add_argument('--warmup-skip', type=int, default=0)
+parser.add_argument('--detailed-warmup', type=int)
 parser.add_argument('--switch-cpu', default='O3CPU')
+parser.add_argument('--cpt-dir')
+parser.add_argument('--anchor-interval', type=int)
+parser.add_argument('--insts-range')
+parser.add_argument('--ckpt-store')
+parser.add_argument('-P', '--param', action='append', default=[])
+parser.add_argument('--result-cache')
+parser.add_argument('--result-cache-size', default='10GB')
+parser.add_argument('--sample-period', type=int, default=10**6)
+parser.add_argument('--sample-warmup', type=int, default=2000)
+parser.add_argument('--sample-unit', type=int, default=1000)
+parser.add_argument('--sample-error', type=float, default=0.03)
+parser.add_argument('--confidence', type=float, default=0.997)
+parser.add_argument('--min-samples', type=int, default=30)
+parser.add_argument('--host-profile', action='store_true')
+parser.add_argument('--telemetry')
+parser.add_argument('--telemetry-interval', type=float, default=30)
+parser.add_argument('--trace-flags')
+parser.add_argument('--trace-window')
+parser.add_argument('-j', '--jobs', type=int, default=1)
+parser.add_argument('--mem-size', default='8GB')
+parser.add_argument('--mem-headroom', default='512MB')
+parser.add_argument('--cores', type=int)
 parser.add_argument('binary')
 parser.add_argument('options', nargs=argparse.REMAINDER)
 args = parser.parse_args()
@@ -39,133 +90,224 @@ if args.mode == 'restore':
         parser.error('-I/--maxinsts is redundant in restore mode.')
     if args.checkpoint_restore is None:
         parser.error("restore mode requires -r/--checkpoint_restore.")
+    if len(args.checkpoint_restore) > 1:
+        for path in args.checkpoint_restore:
+            if parse_checkpoint(path) is None:
+                parser.error('checkpoint %r of a batch must be named by '
+                             'spec_simpoint.py create.' % path)
 else:
     if args.checkpoint_restore is not None:
         parser.error('-r/--checkpoint_restore is redundant in '
                      '%s mode.' % args.mode)
-
-
-#######################################
-#          Cache Definitions          #
-#######################################
-
-
-class L1Cache(Cache):
-    assoc = 2
-    tag_latency = 2
-    data_latency = 2
-    response_latency = 2
-    mshrs = 4
-    tgts_per_mshr = 20
-
-
-class L1ICache(L1Cache):
-    size = '16kB'
-
-
-class L1DCache(L1Cache):
-    size = '64kB'
-
-
-class L2Cache(Cache):
-    size = '256kB'
-    assoc = 8
-    tag_latency = 20
-    data_latency = 20
-    response_latency = 20
-    mshrs = 20
-    tgts_per_mshr = 12
-
-
-class PageTableWalkerCache(Cache):
-    assoc = 2
-    tag_latency = 2
-    data_latency = 2
-    response_latency = 2
-    mshrs = 10
-    size = '1kB'
-    tgts_per_mshr = 12
+if args.anchor_interval is not None and args.mode != 'profile':
+    parser.error('--anchor-interval is only used in profile mode.')
+if args.detailed_warmup is not None and args.mode != 'restore':
+    parser.error('--detailed-warmup is only used in restore mode.')
+if args.warmup_skip and args.mode != 'restore':
+    parser.error('--warmup-skip is only used in restore mode.')
+if args.warmup == 'auto':
+    if args.mode not in ('create', 'restore'):
+        parser.error('--warmup auto is only used in create and restore mode.')
+    if args.warmup_skip:
+        parser.error('--warmup-skip is set by --warmup auto.')
+elif not 0 <= args.warmup_skip <= args.warmup:
+    parser.error('--warmup-skip must be within [0, warmup].')
+if args.result_cache is not None and args.mode != 'restore':
+    parser.error('--result-cache is only used in restore mode.')
+if args.param and args.mode not in ('restore', 'sample'):
+    parser.error('-P/--param is only used in restore and sample mode.')
+if args.mode == 'sample' and \
+        args.sample_period <= args.sample_warmup + args.sample_unit:
+    parser.error('--sample-period must be larger than '
+                 '--sample-warmup + --sample-unit.')
+if (args.trace_flags or args.trace_window) and args.mode != 'restore':
+    parser.error('--trace-flags/--trace-window are only used in restore mode.')
+if args.insts_range is not None and args.mode != 'create':
+    parser.error('--insts-range is only used in create mode.')
+if args.cores is not None and args.mode not in ('create', 'restore'):
+    parser.error('--cores is only used in create and restore mode, profile '
+                 'with one core.')
+
+# Debug flags to enable only in [lo, hi) insts of the measured interval
+trace_flags = []
+trace_window = 0, args.interval
+if args.trace_flags:
+    trace_flags = args.trace_flags.split(',')
+    for flag in trace_flags:
+        if flag not in m5.debug.flags:
+            parser.error('unknown debug flag %r in --trace-flags.' % flag)
+if args.trace_window:
+    lo, hi = args.trace_window.split(':')
+    trace_window = int(lo or 0), int(hi) if hi else args.interval
+    if not 0 <= trace_window[0] < trace_window[1] <= args.interval:
+        parser.error('--trace-window must be within [0, interval].')
+
+# Directory of simpoints.txt, weights.txt and all checkpoints
+cpt_dir = args.cpt_dir or m5.options.outdir
+
+# --warmup auto uses the warmup calibrated by simpoint_driver.py calibrate.
+# Checkpoints keep the (longer) warmup they were created with, restoring
+# them skips its start.
+calibrated_warmup = None
+if args.warmup == 'auto':
+    if args.mode == 'restore':
+        first = parse_checkpoint(args.checkpoint_restore[0])
+        if first is None:
+            parser.error('--warmup auto requires checkpoints named by '
+                         'spec_simpoint.py create.')
+        # Rate mode checkpoints are in a cores_<N> directory below cpt_dir
+        first_dir = os.path.dirname(os.path.normpath(
+            os.path.join(cpt_dir, args.checkpoint_restore[0])))
+        calibrated_warmup = read_warmup(first_dir) or \
+            read_warmup(os.path.dirname(first_dir))
+    else:
+        calibrated_warmup = read_warmup(cpt_dir)
+    if calibrated_warmup is None:
+        print('No calibrated warmup found for %r.' % cpt_dir,
+              'Have you run simpoint_driver.py calibrate?')
+        exit(-1)
+    if args.mode == 'restore':
+        args.warmup = first.warmup
+        args.warmup_skip = max(first.warmup - calibrated_warmup, 0)
+    else:
+        args.warmup = calibrated_warmup
+    print('Using the calibrated warmup of %d insts' % calibrated_warmup)
+
+# Publish progress to a textfile, and time every call. host_profile wraps
+# telemetry's simulate(), so a call is timed as a whole, not per chunk.
+if args.telemetry is not None:
+    telemetry.install(args.telemetry, args.telemetry_interval)
+if args.host_profile:
+    host_profile.install(
+        os.path.join(m5.options.outdir, 'host_profile.jsonl'))
 
 
 #######################################
 #         System Configuration        #
 #######################################
 
-system = System()
-
-system.clk_domain = SrcClockDomain()
-system.clk_domain.clock = '2GHz'
-system.clk_domain.voltage_domain = VoltageDomain()
 
-system.mem_mode = 'atomic'
-system.mem_ranges = [AddrRange('8GB')]
-# system.mem_ranges = [AddrRange('512MB')]
-
-system.cpu = AtomicSimpleCPU()
-
-system.membus = SystemXBar()
-
-if args.mode == 'restore':
-    system.cpu.icache = L1ICache()
-    system.cpu.dcache = L1DCache()
-
-    system.cpu.icache.cpu_side = system.cpu.icache_port
-    system.cpu.dcache.cpu_side = system.cpu.dcache_port
-
-    system.l2bus = L2XBar()
-
-    system.cpu.icache.mem_side = system.l2bus.cpu_side_ports
-    system.cpu.dcache.mem_side = system.l2bus.cpu_side_ports
-
-    # TLB walker caches are necessary to x86 and riscv
-    if m5.defines.buildEnv['TARGET_ISA'] in ['x86', 'riscv']:
-        system.cpu.itb_walker_cache = PageTableWalkerCache()
-        system.cpu.dtb_walker_cache = PageTableWalkerCache()
-        system.cpu.mmu.connectWalkerPorts(
-            system.cpu.itb_walker_cache.cpu_side,
-            system.cpu.dtb_walker_cache.cpu_side)
-
-        system.cpu.itb_walker_cache.mem_side = system.l2bus.cpu_side_ports
-        system.cpu.dtb_walker_cache.mem_side = system.l2bus.cpu_side_ports
-
-    system.l2cache = L2Cache()
-    system.l2cache.cpu_side = system.l2bus.mem_side_ports
-
-    system.l2cache.mem_side = system.membus.cpu_side_ports
+def set_restore_stops(switch_cpu):
+    # With --detailed-warmup, only the tail of the warmup runs on switch_cpu
+    detailed_warmup = args.warmup - args.warmup_skip
+    if args.detailed_warmup is not None:
+        detailed_warmup = min(args.detailed_warmup, detailed_warmup)
 
+    simpoint_start_insts = []
+    if detailed_warmup:
+        simpoint_start_insts.append(detailed_warmup)
+    simpoint_start_insts.append(detailed_warmup + args.interval)
+    # Every core stops on its own in rate mode
+    for cpu in as_list(switch_cpu):
+        cpu.simpoint_start_insts = simpoint_start_insts
+    return detailed_warmup
+
+
+MEM_ALIGN = 64 << 20
+
+
+def auto_mem_size(paths, copies=1):
+    # Fit the memory to the largest footprint among checkpoints in paths,
+    # times the copies of the program to run
+    footprints, sizes = [], set()
+    for path in paths:
+        if not os.path.exists(os.path.join(path, 'm5.cpt')):
+            continue
+        footprint = checkpoint_footprint(path)
+        if footprint is not None:
+            footprints.append(footprint)
+            sizes.update(size for _, size in read_stores(path))
+    if not footprints:
+        return None
+    need = (max(footprints) + parse_size(args.mem_headroom)) * copies
+    need = (need + MEM_ALIGN - 1) // MEM_ALIGN * MEM_ALIGN
+    # Checkpoints of about the right size are restored as they are instead
+    # of being copied
+    if len(sizes) == 1 and need <= min(sizes) <= 2 * need:
+        return sizes.pop()
+    return need
+
+
+def fit_checkpoint(path):
+    # Return path, or a copy of it in outdir if its memory size differs
+    if [size for _, size in read_stores(path)] == [mem_size]:
+        return path, False
+    name = os.path.basename(os.path.normpath(path))
+    dst = os.path.join(m5.options.outdir, '%s.mem_%d' % (name, mem_size))
+    print('Resizing memory of %r to %d bytes' % (path, mem_size))
+    try:
+        resize_checkpoint(path, dst, mem_size)
+    except ValueError as e:
+        print('Cannot resize checkpoint: %s' % e)
+        exit(-1)
+    return dst, True
+
+
+def restore_paths():
+    # Directories holding the m5.cpt of the checkpoints to restore
+    paths = []
+    for path in args.checkpoint_restore:
+        path = os.path.join(cpt_dir, path)
+        name = os.path.basename(os.path.normpath(path))
+        if not os.path.exists(path) and args.ckpt_store is not None:
+            path = os.path.join(args.ckpt_store, 'ckpts', name)
+        paths.append(path)
+    return paths
+
+
+# Rate mode runs a copy of the program on each of --cores cores. Restore
+# takes the core count from the checkpoint. Rate mode checkpoints are kept
+# in cores_<N> below --cpt-dir, next to simpoints.txt.
+cores = args.cores or 1
+if args.mode == 'restore' and args.cores is None:
+    first_m5cpt = os.path.join(restore_paths()[0], 'm5.cpt')
+    if os.path.exists(first_m5cpt):
+        cores = checkpoint_cores(os.path.dirname(first_m5cpt))
+if cores > 1 and args.trace_flags:
+    parser.error('--trace-flags is only used with one core.')
+ckpt_root = cpt_dir
+if cores > 1:
+    ckpt_root = os.path.join(cpt_dir, 'cores_%d' % cores)
+    # m5.checkpoint() only creates the last component of its path
+    if args.mode == 'create':
+        os.makedirs(ckpt_root, exist_ok=True)
+
+# With --mem-size auto, size the memory by the footprint recorded in the
+# checkpoints to restore, or in the anchors and checkpoints to create from
+if args.mem_size == 'auto':
+    copies = 1
+    if args.mode == 'restore':
+        paths = restore_paths()
+    elif args.mode == 'create' and os.path.isdir(cpt_dir):
+        # One core checkpoints only have one copy of the program
+        paths = [path for _, path in find_anchors(cpt_dir)] + \
+            [cpt.path for cpt in find_checkpoints(cpt_dir)]
+        paths = [path for path in paths if is_complete(path)]
+        copies = cores
+        if cores > 1 and os.path.isdir(ckpt_root):
+            rate_paths = [cpt.path for cpt in find_checkpoints(ckpt_root)
+                          if is_complete(cpt.path)]
+            if rate_paths:
+                paths, copies = rate_paths, 1
+    else:
+        paths = []
+    mem_size = auto_mem_size(paths, copies)
+    if mem_size is None:
+        mem_size = parse_size('8GB')
+        print('No memory footprint found, using 8GB')
+    else:
+        print('Using %d MB of memory' % (mem_size >> 20))
 else:
-    system.cpu.icache_port = system.membus.cpu_side_ports
-    system.cpu.dcache_port = system.membus.cpu_side_ports
-
-system.cpu.createInterruptController()
-
-# For x86 only, make sure the interrupts are connected to the memory
-# Note: these are directly connected to the memory bus and are not cached
-if m5.defines.buildEnv['TARGET_ISA'] == "x86":
-    system.cpu.interrupts[0].pio = system.membus.mem_side_ports
-    system.cpu.interrupts[0].int_requestor = system.membus.cpu_side_ports
-    system.cpu.interrupts[0].int_responder = system.membus.mem_side_ports
-
-system.mem_ctrl = MemCtrl()
-system.mem_ctrl.dram = DDR3_1600_8x8()
-system.mem_ctrl.dram.range = system.mem_ranges[0]
-system.mem_ctrl.port = system.membus.mem_side_ports
-
-system.system_port = system.membus.cpu_side_ports
-
-system.workload = SEWorkload.init_compatible(args.binary)
-
-process = Process()
-process.cmd = [args.binary] + args.options
-if args.input is not None:
-    process.input = args.input
-if args.output is not None:
-    process.output = args.output
-if args.errout is not None:
-    process.errout = args.errout
+    mem_size = parse_size(args.mem_size)
 
-system.cpu.workload = process
-system.cpu.createThreads()
+# Caches are only attached when simulating in detail, checkpoints do not
+# contain them
+system = build_system(args.binary, args.options,
+                      caches=args.mode in ('restore', 'sample'),
+                      mem_size=mem_size,
+                      input=args.input, output=args.output,
+                      errout=args.errout, cores=cores)
+cpus = as_list(system.cpu)
 
 
 #######################################
@@ -176,8 +318,8 @@ if args.mode == 'profile':
     system.cpu.addSimPointProbe(args.interval)
 
 elif args.mode == 'create':
-    spath = os.path.join(m5.options.outdir, 'simpoints.txt')
-    wpath = os.path.join(m5.options.outdir, 'weights.txt')
+    spath = os.path.join(cpt_dir, 'simpoints.txt')
+    wpath = os.path.join(cpt_dir, 'weights.txt')
     try:
         with open(spath) as f:
             ss = f.readlines()
@@ -197,44 +339,279 @@ elif args.mode == 'create':
     simpoints.sort()
 
     simpoint_start_insts = []
+    ckpt_names = []
     for s, w in simpoints:
         insts = s * args.interval
-        if insts > args.warmup:
-            insts -= args.warmup
-        else:
-            insts = 0
-        simpoint_start_insts.append(insts)
+        warmup = args.warmup if insts > args.warmup else 0
+        simpoint_start_insts.append(insts - warmup)
 
-    print('Found %d start points' % len(simpoint_start_insts))
-    system.cpu.simpoint_start_insts = simpoint_start_insts
+        ckpt = 'cpt.insts_%d.interval_%d.warmup_%d.weight_%r'
+        ckpt_names.append(ckpt % (insts, args.interval, warmup, w))
+
+    # Only create checkpoints starting in [lo, hi) if --insts-range lo:hi
+    if args.insts_range is not None:
+        lo, hi = args.insts_range.split(':')
+        lo = int(lo) if lo else 0
+        hi = int(hi) if hi else float('inf')
+        in_range = [lo <= insts < hi for insts in simpoint_start_insts]
+        simpoints = [sp for sp, r in zip(simpoints, in_range) if r]
+        simpoint_start_insts = [
+            ssi for ssi, r in zip(simpoint_start_insts, in_range) if r]
+        ckpt_names = [n for n, r in zip(ckpt_names, in_range) if r]
 
-else:
-    cpu_class = getattr(m5.objects, args.switch_cpu)
+    print('Found %d start points' % len(simpoint_start_insts))
 
-    switch_cpu = cpu_class(switched_out=True, cpu_id=0)
-    switch_cpu.workload = system.cpu.workload
-    switch_cpu.clk_domain = system.cpu.clk_domain
-    switch_cpu.progress_interval = system.cpu.progress_interval
-    switch_cpu.isa = system.cpu.isa
+    # Skip checkpoints completed by a previous (maybe killed) run, which can
+    # also be restored from like anchors. Anchors have only one core.
+    bases = [(insts, path) for insts, path in find_anchors(cpt_dir)
+             if is_complete(path) and cores == 1]
+    todo = []
+    for i, ckpt in enumerate(ckpt_names):
+        ckpt_dir = os.path.join(ckpt_root, ckpt)
+        if is_complete(ckpt_dir):
+            bases.append((simpoint_start_insts[i], ckpt_dir))
+            continue
+        if os.path.exists(ckpt_dir):
+            print('Removing incomplete checkpoint %r' % ckpt_dir)
+            shutil.rmtree(ckpt_dir)
+        todo.append(i)
+
+    if len(todo) < len(ckpt_names):
+        print('Found %d complete checkpoints'
+              % (len(ckpt_names) - len(todo)))
+    simpoints = [simpoints[i] for i in todo]
+    simpoint_start_insts = [simpoint_start_insts[i] for i in todo]
+    ckpt_names = [ckpt_names[i] for i in todo]
+    if not simpoint_start_insts:
+        print('Done creating checkpoints')
+        exit(0)
+
+    # Fast-forward from the latest anchor or complete checkpoint before the
+    # first start point. Instructions are counted from where it was taken.
+    anchor_insts, anchor_dir = 0, None
+    for insts, path in sorted(bases):
+        if insts <= simpoint_start_insts[0]:
+            anchor_insts, anchor_dir = insts, path
+
+    # The copies of the program run in lockstep on the atomic CPUs (one
+    # instruction per cycle each), so the first core stands for all
+    cpus[0].simpoint_start_insts = [
+        ssi - anchor_insts for ssi in simpoint_start_insts]
+
+elif args.mode == 'sample':
+    switch_cpu = add_switch_cpu(system, args.switch_cpu)
 
-    simpoint_start_insts = []
-    if args.warmup:
-        simpoint_start_insts.append(args.warmup)
-    simpoint_start_insts.append(args.warmup + args.interval)
-    switch_cpu.simpoint_start_insts = simpoint_start_insts
+else:
+    switch_cpu = add_switch_cpu(system, args.switch_cpu)
+    detailed_warmup = set_restore_stops(switch_cpu)
 
-    switch_cpu.createThreads()
-    system.switch_cpu = switch_cpu
+# Override parameters of the system, e.g. -P l2.size=512kB
+for param in args.param:
+    key, _, value = param.partition('=')
+    try:
+        set_param(system, key, value)
+    except (AttributeError, TypeError, ValueError) as e:
+        parser.error('invalid -P/--param %r: %s' % (param, e))
 
 if args.maxinsts is not None:
-    system.cpu.max_insts_any_thread = args.maxinsts
+    for cpu in cpus:
+        cpu.max_insts_any_thread = args.maxinsts
 
 root = Root(full_system=False, system=system)
 
+
+#######################################
+#            Batch Restore            #
+#######################################
+
+
+def fork_errors():
+    # State a forked child cannot use safely
+    errors = []
+    if threading.active_count() > 1:
+        errors.append('%d Python threads are running'
+                      % threading.active_count())
+    if any(getattr(obj, '_ccObject', None) is not None
+           for obj in root.descendants()):
+        errors.append('SimObjects are already instantiated')
+    return errors
+
+
+def shared_files():
+    files = []
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            if int(fd) > 2:
+                files.append(os.readlink(os.path.join('/proc/self/fd', fd)))
+        except OSError:
+            pass
+    return [f for f in files if not f.startswith('/proc/')]
+
+
+def fork_restores(paths, jobs):
+    # Fork one child per checkpoint from the configured but not instantiated
+    # system. Return the checkpoint in the child; the parent waits for all
+    # children and exits.
+    errors = fork_errors()
+    if errors:
+        print('Cannot fork restores:', '; '.join(errors))
+        exit(-1)
+    files = shared_files()
+    if files:
+        print('Files shared with the children:', ', '.join(files))
+
+    print('Restoring %d checkpoints with %d jobs' % (len(paths), jobs))
+    running, failed = {}, []
+
+    def wait_one():
+        pid, status = os.wait()
+        path = running.pop(pid)
+        ok = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        if not ok:
+            failed.append(path)
+        print('[%d/%d] %s %s' % (len(paths) - len(running) - len(todo),
+                                 len(paths), path, 'done' if ok else 'FAILED'))
+
+    todo = list(paths)
+    while todo:
+        if len(running) >= jobs:
+            wait_one()
+            continue
+        path = todo.pop(0)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            return path
+        running[pid] = path
+    while running:
+        wait_one()
+
+    for path in failed:
+        print('Failed:', path)
+    # Nothing was instantiated here, skip gem5's exit-time stats dump
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(1 if failed else 0)
+
+
+def setup_child(path):
+    # Give the child its own outdir, log, stats file and debug file, and the
+    # interval and warmup its checkpoint was created with
+    cpt = parse_checkpoint(path)
+    outdir = os.path.join(m5.options.outdir, cpt.name)
+    os.makedirs(outdir, exist_ok=True)
+    log = os.open(os.path.join(outdir, 'gem5.log'),
+                  os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    os.close(log)
+
+    m5.options.outdir = outdir
+    _m5.core.setOutputDir(outdir)
+    m5.stats.outputList.clear()
+    m5.stats.addStatVisitor(m5.options.stats_file)
+    if m5.options.debug_file:
+        _m5.trace.output(m5.options.debug_file)
+
+    if args.host_profile:
+        host_profile.install(os.path.join(outdir, 'host_profile.jsonl'))
+    if args.telemetry is not None:
+        base, ext = os.path.splitext(args.telemetry)
+        telemetry.install('%s.%s%s' % (base, cpt.name, ext),
+                          args.telemetry_interval, outdir)
+
+    args.interval, args.warmup = cpt.interval, cpt.warmup
+    if calibrated_warmup is not None:
+        args.warmup_skip = max(cpt.warmup - calibrated_warmup, 0)
+    elif args.warmup_skip > args.warmup:
+        print('--warmup-skip is beyond the warmup of %r' % path)
+        exit(-1)
+
+
+checkpoint_restore = None
+if args.mode == 'restore':
+    checkpoint_restore = args.checkpoint_restore[0]
+    if len(args.checkpoint_restore) > 1:
+        checkpoint_restore = fork_restores(args.checkpoint_restore, args.jobs)
+        setup_child(checkpoint_restore)
+        print('Restoring batch member %r' % checkpoint_restore)
+        detailed_warmup = set_restore_stops(system.switch_cpu)
+        if not args.trace_window:
+            trace_window = 0, args.interval
+        if trace_window[1] > args.interval:
+            print('--trace-window is beyond the interval of %r'
+                  % checkpoint_restore)
+            exit(-1)
+
+# Look up a finished run of the same binary, checkpoint, configuration and
+# gem5 build in the result cache before doing any real work. A cached result
+# has no trace, so traced runs always simulate.
+result_key = None
+if args.mode == 'restore' and args.result_cache is not None \
+        and not trace_flags:
+    ckpt_name = os.path.basename(os.path.normpath(checkpoint_restore))
+    m5cpt = os.path.join(cpt_dir, checkpoint_restore, 'm5.cpt')
+    if not os.path.exists(m5cpt) and args.ckpt_store is not None:
+        m5cpt = os.path.join(args.ckpt_store, 'ckpts', ckpt_name, 'm5.cpt')
+
+    # The same steps as m5.instantiate() takes before writing config.ini
+    for obj in root.descendants():
+        obj.adoptOrphanParams()
+    for obj in root.descendants():
+        obj.unproxyParams()
+    config = io.StringIO()
+    for obj in sorted(root.descendants(), key=lambda o: o.path()):
+        obj.print_ini(config)
+
+    exe = os.path.realpath('/proc/self/exe')
+    exe_stat = os.stat(exe)
+    result_key = result_cache.run_key(
+        binary=result_cache.file_digest(args.binary),
+        checkpoint=[ckpt_name, result_cache.file_digest(m5cpt)],
+        config=config.getvalue(),
+        options=[args.warmup, args.interval, args.detailed_warmup,
+                 args.warmup_skip],
+        gem5=[_m5.core.gem5Version, _m5.core.compileDate, exe,
+              exe_stat.st_size, exe_stat.st_mtime_ns])
+    with open(os.path.join(m5.options.outdir, 'result_key.txt'), 'w') as f:
+        f.write(result_key + '\n')
+
+    if result_cache.lookup(args.result_cache, result_key, m5.options.outdir):
+        print('Found result %s in cache %r' % (result_key, args.result_cache))
+        print('Done running SimPoint')
+        # Nothing is instantiated, skip the exit-time stats dump which would
+        # overwrite the cached stats.txt
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
 if args.mode == 'restore':
-    ckpt_dir = os.path.join(m5.options.outdir, args.checkpoint_restore)
-    print('Restoring checkpoint %r' % ckpt_dir)
-    m5.instantiate(ckpt_dir)
+    ckpt_dir = os.path.join(cpt_dir, checkpoint_restore)
+    ckpt_name = os.path.basename(os.path.normpath(ckpt_dir))
+    materialized = (args.ckpt_store is not None
+                    and not is_complete(ckpt_dir)
+                    and ckpt_store.contains(args.ckpt_store, ckpt_name))
+    if materialized:
+        # Rebuild the checkpoint from the deduplicated store into outdir,
+        # it is not needed any more once instantiated
+        ckpt_dir = os.path.join(m5.options.outdir, ckpt_name)
+        print('Materializing %r from store %r' % (ckpt_dir, args.ckpt_store))
+        ckpt_store.materialize(args.ckpt_store, ckpt_name, ckpt_dir)
+    restore_dir, resized = fit_checkpoint(ckpt_dir)
+    if resized and materialized:
+        shutil.rmtree(ckpt_dir)
+
+    print('Restoring checkpoint %r' % restore_dir)
+    m5.instantiate(restore_dir)
+    if materialized or resized:
+        shutil.rmtree(restore_dir)
+elif args.mode == 'create' and anchor_dir is not None:
+    print('Restoring checkpoint %r @ %d insts' % (anchor_dir, anchor_insts))
+    restore_dir, resized = fit_checkpoint(anchor_dir)
+    m5.instantiate(restore_dir)
+    if resized:
+        shutil.rmtree(restore_dir)
 else:
     print('Instantiating')
     m5.instantiate()
@@ -244,54 +621,275 @@ else:
 #           Real Simulation           #
 #######################################
 
+CAUSE_EXIT = 'exiting with last active thread context'
 CAUSE_SIMPOINT = 'simpoint starting point found'
+CAUSE_ANCHOR = 'anchor checkpoint'
+CAUSE_WARMUP = 'functional warmup done'
+CAUSE_WARMUP_SKIP = 'warmup skipped'
+CAUSE_FAST_FORWARD = 'fast-forward done'
+CAUSE_SAMPLE_WARMUP = 'sample warmup done'
+CAUSE_SAMPLE = 'sample unit done'
+CAUSE_TRACE_ON = 'trace window start'
+CAUSE_TRACE_OFF = 'trace window end'
+
+
+def set_trace(flags, on):
+    for flag in flags:
+        if on:
+            m5.debug.flags[flag].enable()
+        else:
+            m5.debug.flags[flag].disable()
+
+
+def simulate_cores(cpus, stop, stops, reached):
+    # Rate mode: simulate until each of cpus has committed stop insts since
+    # it was switched in. Each CPU exits at every one of its stops
+    # (simpoint_start_insts) on its own, reached[i] maps the stops CPU i got
+    # to to the tick it got there. A core that is done keeps running, so the
+    # others see the same contention until the last one is done.
+    exit_event = None
+    while any(stop not in r for r in reached):
+        telemetry.expect(sum(max(stop - cpu.totalInsts(), 0)
+                             for cpu in cpus))
+        exit_event = m5.simulate()
+        if exit_event.getCause() != CAUSE_SIMPOINT:
+            break
+        for cpu, r in zip(cpus, reached):
+            for s in stops:
+                if s not in r and cpu.totalInsts() >= s:
+                    r[s] = m5.curTick()
+    return exit_event
+
+
+def write_rate(path, cpus, start, end, reached):
+    # Per-core CPI of rate mode, each over its own interval
+    clock_period = system.clk_domain.clock[0].getValue()
+    results = []
+    for cpu, r in zip(cpus, reached):
+        cpi = (r[end] - r[start]) / clock_period / args.interval
+        results.append({'cpu': cpu.path(), 'start': r[start],
+                        'end': r[end], 'cpi': cpi})
+        print('%s: CPI %.4f' % (cpu.path(), cpi))
+    with open(path, 'w') as f:
+        json.dump({'interval': args.interval, 'cores': results,
+                   'cpi': sum(r['cpi'] for r in results) / len(results)},
+                  f, indent=2)
+
+
+if args.mode == 'profile' and args.anchor_interval:
+    # Drop an anchor checkpoint every --anchor-interval insts, so that create
+    # mode can start from the nearest one instead of instruction 0
+    insts = 0
+    while True:
+        print('Simulating with profiling for %d insts' % args.anchor_interval)
+        system.cpu.scheduleInstStop(0, args.anchor_interval, CAUSE_ANCHOR)
+        telemetry.expect(args.anchor_interval)
+        exit_event = m5.simulate()
+        if exit_event.getCause() != CAUSE_ANCHOR:
+            break
 
-if args.mode == 'profile':
+        insts += args.anchor_interval
+        ckpt_dir = os.path.join(cpt_dir, 'anchor.insts_%d' % insts)
+        print('Creating anchor checkpoint %r' % ckpt_dir)
+        m5.checkpoint(ckpt_dir)
+        mark_complete(ckpt_dir)
+    if exit_event.getCause() == CAUSE_EXIT:
+        print('Done profiling')
+
+elif args.mode == 'profile':
     print('Simulating with profiling')
     exit_event = m5.simulate()
+    # simpoint.bb.gz of a killed profile is truncated, pipeline.py waits
+    # for this instead
+    if exit_event.getCause() == CAUSE_EXIT:
+        print('Done profiling')
 
 elif args.mode == 'create':
-    for (s, w), ssi in zip(simpoints, simpoint_start_insts):
+    insts = anchor_insts
+    for ckpt, ssi in zip(ckpt_names, simpoint_start_insts):
         print('Simulating until %d insts' % ssi)
+        telemetry.expect(ssi - insts)
+        insts = ssi
         exit_event = m5.simulate()
         exit_cause = exit_event.getCause()
         if exit_cause != CAUSE_SIMPOINT:
             break
 
         # Create checkpoint only if we are at start point
-        insts = s * args.interval
-        warmup = args.warmup if insts > args.warmup else 0
-
-        ckpt = 'cpt.insts_%d.interval_%d.warmup_%d.weight_%r'
-        ckpt = ckpt % (insts, args.interval, warmup, w)
-        ckpt_dir = os.path.join(m5.options.outdir, ckpt)
+        ckpt_dir = os.path.join(ckpt_root, ckpt)
         print('Creating checkpoint %r' % (ckpt_dir))
         m5.checkpoint(ckpt_dir)
+        mark_complete(ckpt_dir)
+    else:
+        print('Done creating checkpoints')
+
+elif args.mode == 'sample':
+    # SMARTS-style systematic sampling: every --sample-period insts, fast-
+    # forward functionally on the atomic CPU (which keeps the caches warm),
+    # then warm up the pipeline and measure --sample-unit insts in detail.
+    # Stop once the confidence interval of the mean CPI is tight enough.
+    z = NormalDist().inv_cdf((1 + args.confidence) / 2)
+    clock_period = system.clk_domain.clock[0].getValue()
+    fast_forward = args.sample_period - args.sample_warmup - args.sample_unit
+
+    # Running mean and variance of per-sample CPI (Welford's algorithm)
+    n, mean, m2 = 0, 0.0, 0.0
+    insts = 0
+    error = float('inf')
+    spath = os.path.join(m5.options.outdir, 'samples.txt')
+    with open(spath, 'w') as f:
+        while True:
+            system.cpu.scheduleInstStop(0, fast_forward, CAUSE_FAST_FORWARD)
+            telemetry.expect(fast_forward)
+            exit_event = m5.simulate()
+            if exit_event.getCause() != CAUSE_FAST_FORWARD:
+                break
+            insts += fast_forward
+
+            m5.switchCpus(system, switch_pairs(system))
+            if args.sample_warmup:
+                system.switch_cpu.scheduleInstStop(
+                    0, args.sample_warmup, CAUSE_SAMPLE_WARMUP)
+                telemetry.expect(args.sample_warmup)
+                exit_event = m5.simulate()
+                if exit_event.getCause() != CAUSE_SAMPLE_WARMUP:
+                    break
+            start = m5.curTick()
+            system.switch_cpu.scheduleInstStop(
+                0, args.sample_unit, CAUSE_SAMPLE)
+            telemetry.expect(args.sample_unit)
+            exit_event = m5.simulate()
+            if exit_event.getCause() != CAUSE_SAMPLE:
+                break
+            cpi = (m5.curTick() - start) / clock_period / args.sample_unit
+            insts += args.sample_warmup
+            m5.switchCpus(system, switch_pairs(system, back=True))
+
+            f.write('%d %r\n' % (insts, cpi))
+            f.flush()
+            insts += args.sample_unit
+
+            n += 1
+            delta = cpi - mean
+            mean += delta / n
+            m2 += delta * (cpi - mean)
+            if n < 2:
+                continue
+            error = z * (m2 / (n - 1) / n) ** 0.5 / mean
+            if n % 100 == 0:
+                print('%d samples @ %d insts: CPI = %.4f +- %.2f%%'
+                      % (n, insts, mean, error * 100))
+            if n >= args.min_samples and error <= args.sample_error:
+                break
+
+    if n:
+        print('Sampled CPI = %.4f +- %.2f%% (confidence %g) from %d samples'
+              % (mean, error * 100, args.confidence, n))
+    if error <= args.sample_error and n >= args.min_samples:
+        print('Done sampling')
+    else:
+        print('Program ended before reaching the error bound')
 
 else:
-    print('Pre-warming up the system for 10000 ticks')
-    m5.simulate(10000)
-
-    # Switch CPUs
-    print('Switching CPUs:', system.cpu.type, '->', system.switch_cpu.type)
-    switch_cpu_list = [(system.cpu, system.switch_cpu)]
-    m5.switchCpus(system, switch_cpu_list)
-
-    # Warmup
-    if args.warmup:
-        print('Warming up for %d insts' % args.warmup)
+    warmed_up = True
+    if args.warmup_skip:
+        # Run the start of the warmup on the atomic CPU and then write back
+        # and invalidate all caches, as if the checkpoint had been created
+        # warmup - skip insts before the interval. Only the caches start
+        # cold again, TLBs and branch predictors are not flushed.
+        print('Skipping %d insts of the warmup' % args.warmup_skip)
+        cpus[0].scheduleInstStop(0, args.warmup_skip, CAUSE_WARMUP_SKIP)
+        telemetry.expect(args.warmup_skip)
         exit_event = m5.simulate()
-        exit_cause = exit_event.getCause()
-        if exit_cause == CAUSE_SIMPOINT:
+        warmed_up = exit_event.getCause() == CAUSE_WARMUP_SKIP
+        m5.memWriteback(system)
+        m5.memInvalidate(system)
+
+    functional_warmup = args.warmup - args.warmup_skip - detailed_warmup
+    if warmed_up and args.detailed_warmup is None:
+        print('Pre-warming up the system for 10000 ticks')
+        m5.simulate(10000)
+    elif warmed_up and functional_warmup:
+        # The atomic CPU warms up the caches attached to it, which costs far
+        # less host time than warming them up on switch_cpu
+        print('Functionally warming up for %d insts' % functional_warmup)
+        cpus[0].scheduleInstStop(0, functional_warmup, CAUSE_WARMUP)
+        telemetry.expect(functional_warmup)
+        exit_event = m5.simulate()
+        warmed_up = exit_event.getCause() == CAUSE_WARMUP
+
+    switch_cpus = as_list(system.switch_cpu)
+    core_stops = [stop for stop in (detailed_warmup,
+                                    detailed_warmup + args.interval) if stop]
+    if warmed_up:
+        # Switch CPUs
+        print('Switching CPUs:', cpus[0].type, '->', switch_cpus[0].type)
+        m5.switchCpus(system, switch_pairs(system))
+        reached = [{0: m5.curTick()} for _ in switch_cpus]
+
+        # Warmup
+        if detailed_warmup and cores > 1:
+            print('Warming up for %d insts on each core' % detailed_warmup)
+            exit_event = simulate_cores(switch_cpus, detailed_warmup,
+                                        core_stops, reached)
+            warmed_up = exit_event.getCause() == CAUSE_SIMPOINT
+        elif detailed_warmup:
+            print('Warming up for %d insts' % detailed_warmup)
+            telemetry.expect(detailed_warmup)
+            exit_event = m5.simulate()
+            warmed_up = exit_event.getCause() == CAUSE_SIMPOINT
+        if warmed_up and args.warmup:
             m5.stats.dump()
             m5.stats.reset()
 
-    # Simulate
-    if (not args.warmup) or exit_cause == CAUSE_SIMPOINT:
-        print('Simulating for %d insts' % args.interval)
-        exit_event = m5.simulate()
-        exit_cause = exit_event.getCause()
-        if exit_cause == CAUSE_SIMPOINT:
-            print('Done running SimPoint')
+    if warmed_up and cores > 1:
+        print('Simulating for %d insts on each core' % args.interval)
+        exit_event = simulate_cores(switch_cpus, core_stops[-1], core_stops,
+                                    reached)
+    elif warmed_up:
+        # Simulate, tracing only inside --trace-window. Pre-warm and warmup
+        # are never traced.
+        lo, hi = trace_window
+        stops = []
+        if trace_flags and lo:
+            stops.append((lo, CAUSE_TRACE_ON))
+        if trace_flags and hi < args.interval:
+            stops.append((hi, CAUSE_TRACE_OFF))
+        if trace_flags and not lo:
+            print('Tracing %s' % ','.join(trace_flags))
+            set_trace(trace_flags, True)
+
+        insts = 0
+        for stop, cause in stops:
+            print('Simulating for %d insts' % (stop - insts))
+            system.switch_cpu.scheduleInstStop(0, stop - insts, cause)
+            telemetry.expect(stop - insts)
+            exit_event = m5.simulate()
+            if exit_event.getCause() != cause:
+                break
+            insts = stop
+            print('%s %s' % ('Tracing' if cause == CAUSE_TRACE_ON
+                             else 'Stop tracing', ','.join(trace_flags)))
+            set_trace(trace_flags, cause == CAUSE_TRACE_ON)
+        else:
+            print('Simulating for %d insts' % (args.interval - insts))
+            telemetry.expect(args.interval - insts)
+            exit_event = m5.simulate()
+        set_trace(trace_flags, False)
+
+    if warmed_up and exit_event.getCause() == CAUSE_SIMPOINT:
+        if cores > 1:
+            write_rate(os.path.join(m5.options.outdir, 'rate.json'),
+                       switch_cpus, detailed_warmup, core_stops[-1], reached)
+        print('Done running SimPoint')
+
+        if result_key is not None:
+            # The exit-time dump happens too late to be cached
+            m5.stats.dump()
+            meta = {'binary': args.binary, 'checkpoint': ckpt_name,
+                    'argv': sys.argv}
+            result_cache.store(args.result_cache, result_key,
+                               m5.options.outdir, meta,
+                               parse_size(args.result_cache_size))
 
 print('Exiting @ tick %d because %s' % (m5.curTick(), exit_event.getCause()))
@@ -0,0 +1,140 @@
+import os
+import json
+import struct
+import argparse
+try:
+    import numpy as np
+except ImportError:
+    # Only reading samples needs NumPy, gem5's Python may not have it
+    np = None
+try:
+    import m5
+except ImportError:
+    # Reading samples does not need gem5
+    m5 = None
+
+
+# Binary time series of a few statistics, one row per sample:
+#   0   8 bytes   MAGIC
+#   8   uint64    number of rows written so far
+#   16  uint64    length of the JSON header
+#   24  JSON      {"columns": ["tick", stat, ...], "dtype": "<f8"}
+#   ... padding to 8 bytes, then rows of float64
+# The file is grown ahead of the rows (doubling its capacity) and the row
+# count is updated after every row, so a killed run leaves a readable file.
+
+MAGIC = b'M5SAMPL\0'
+HEAD = struct.Struct('<8sQQ')
+DTYPE = '<f8'
+
+
+def find_stats(names, root=None):
+    # Map each name in names (e.g. 'system.cpu.ipc' or
+    # 'system.l2cache.overallMisses::total') to (stat, subname). Only works
+    # after m5.instantiate().
+    if root is None:
+        root = m5.objects.Root.getInstance()
+    wanted = {name.split('::')[0]: name for name in names}
+    found = {}
+
+    def visit(group, path):
+        for stat in group.getStats():
+            full = path + stat.name
+            if full in wanted:
+                found[full] = stat
+        for name, child in group.getStatGroups().items():
+            visit(child, path + name + '.')
+
+    visit(root, '')
+    missing = [name for base, name in wanted.items() if base not in found]
+    if missing:
+        raise ValueError('unknown statistics: %s' % ', '.join(missing))
+    return [(found[name.split('::')[0]], name.partition('::')[2])
+            for name in names]
+
+
+def stat_value(stat, subname=''):
+    stat.prepare()
+    value = stat.value
+    if not isinstance(value, (list, tuple)):
+        return float(value)
+    if not subname or subname == 'total':
+        return float(stat.total if hasattr(stat, 'total') else sum(value))
+    return float(value[list(stat.subnames).index(subname)])
+
+
+class StatSampler:
+    def __init__(self, path, names, capacity=4096):
+        self.path = path
+        self.names = list(names)
+        self.columns = ['tick'] + self.names
+        self.stats = None
+        self.rows = 0
+
+        header = json.dumps({'columns': self.columns, 'dtype': DTYPE})
+        header = header.encode()
+        self.data_offset = (HEAD.size + len(header) + 7) // 8 * 8
+        self.row_size = 8 * len(self.columns)
+        self.row = struct.Struct('<%dd' % len(self.columns))
+        self.capacity = capacity
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.pwrite(self.fd, HEAD.pack(MAGIC, 0, len(header)) + header, 0)
+        os.ftruncate(self.fd, self.data_offset + capacity * self.row_size)
+
+    def sample(self):
+        if self.stats is None:
+            self.stats = find_stats(self.names)
+        if self.rows == self.capacity:
+            self.capacity *= 2
+            os.ftruncate(self.fd,
+                         self.data_offset + self.capacity * self.row_size)
+
+        row = [m5.curTick()] + [stat_value(s, sub) for s, sub in self.stats]
+        os.pwrite(self.fd, self.row.pack(*row),
+                  self.data_offset + self.rows * self.row_size)
+        self.rows += 1
+        os.pwrite(self.fd, struct.pack('<Q', self.rows), 8)
+
+    def close(self):
+        if self.fd is None:
+            return
+        os.ftruncate(self.fd, self.data_offset + self.rows * self.row_size)
+        os.close(self.fd)
+        self.fd = None
+
+
+def read_samples(path):
+    # Return (columns, array of shape (rows, len(columns))), memory-mapped
+    with open(path, 'rb') as f:
+        magic, rows, length = HEAD.unpack(f.read(HEAD.size))
+        if magic != MAGIC:
+            raise ValueError('%r is not a stat sample file' % path)
+        header = json.loads(f.read(length))
+    columns = header['columns']
+    if not rows:
+        return columns, np.zeros((0, len(columns)), header['dtype'])
+    data_offset = (HEAD.size + length + 7) // 8 * 8
+    data = np.memmap(path, header['dtype'], 'r', data_offset,
+                     (rows, len(columns)))
+    return columns, data
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print a stat sample file as text.')
+    parser.add_argument('samples')
+    parser.add_argument('--delta', action='store_true',
+                        help='print the change since the previous sample')
+    args = parser.parse_args()
+
+    columns, data = read_samples(args.samples)
+    if args.delta:
+        data = np.diff(data, axis=0, prepend=np.zeros((1, len(columns))))
+    print(' '.join(columns))
+    for row in data:
+        print(' '.join('%.17g' % v for v in row))
+
+
+if __name__ == '__main__':
+    main()
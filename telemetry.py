@@ -0,0 +1,107 @@
+import os
+import time
+import m5
+
+
+# Publish the progress of a running simulation as a Prometheus textfile
+# (e.g. for node_exporter's textfile collector, or just `cat`). m5.simulate()
+# is replaced by a loop of shorter simulate() calls whose length adapts so
+# that the file is updated about every `interval` seconds of host time.
+# Returning to Python that rarely costs nothing measurable.
+
+LIMIT_CAUSE = 'simulate() limit reached'
+
+_path = None
+_interval = None
+_simulate = None
+_chunk = 10**9
+_labels = ''
+_target = None
+_last = None
+
+
+def sim_insts():
+    root = m5.objects.Root.getInstance()
+    return sum(obj.totalInsts() for obj in root.descendants()
+               if isinstance(obj, m5.objects.BaseCPU))
+
+
+def active_cpus():
+    root = m5.objects.Root.getInstance()
+    return [obj.path() for obj in root.descendants()
+            if isinstance(obj, m5.objects.BaseCPU) and not obj.switchedOut()]
+
+
+def expect(insts):
+    # The next stop the script is waiting for is insts from now, used for
+    # the ETA. A no-op unless install() was called.
+    global _target
+    if _path is not None:
+        _target = sim_insts() + insts
+
+
+def update():
+    global _last
+    now, tick, insts = time.time(), m5.curTick(), sim_insts()
+    kips = float('nan')
+    if _last is not None and now > _last[0]:
+        kips = (insts - _last[2]) / (now - _last[0]) / 1000
+    eta = float('nan')
+    if _target is not None and kips > 0:
+        eta = max(_target - insts, 0) / kips / 1000
+    _last = now, tick, insts
+
+    metrics = [
+        ('gem5_sim_ticks', 'Current simulated tick', tick),
+        ('gem5_sim_insts', 'Instructions committed by all CPUs', insts),
+        ('gem5_sim_kips', 'Simulated kilo-instructions per host second',
+         kips),
+        ('gem5_eta_seconds', 'Host seconds to the next expected stop', eta),
+        ('gem5_last_update_seconds', 'Unix time of this update', now),
+    ]
+    lines = []
+    for name, help, value in metrics:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s{%s} %s' % (name, _labels, value))
+    lines.append('# HELP gem5_active_cpu CPUs that are not switched out')
+    lines.append('# TYPE gem5_active_cpu gauge')
+    for cpu in active_cpus():
+        lines.append('gem5_active_cpu{%s,cpu="%s"} 1' % (_labels, cpu))
+
+    # Replace the file atomically so that readers never see half of it
+    tmp = '%s.tmp.%d' % (_path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, _path)
+
+
+def simulate(ticks=-1):
+    global _chunk
+    end = None if ticks is None or ticks < 0 else m5.curTick() + ticks
+    while True:
+        chunk = _chunk if end is None else min(_chunk, end - m5.curTick())
+        start = time.time()
+        exit_event = _simulate(chunk)
+        elapsed = time.time() - start
+        update()
+
+        # Aim the next chunk at the update interval
+        if exit_event.getCause() == LIMIT_CAUSE and chunk == _chunk:
+            scale = _interval / elapsed if elapsed > 0 else 4
+            _chunk = max(1, int(_chunk * min(max(scale, 0.25), 4)))
+
+        if exit_event.getCause() != LIMIT_CAUSE or \
+                (end is not None and m5.curTick() >= end):
+            return exit_event
+
+
+def install(path, interval=30, job=None):
+    # Installing again (e.g. in a forked child) only changes the output
+    global _path, _interval, _simulate, _labels, _target, _last
+    if _path is None:
+        _simulate = m5.simulate
+        m5.simulate = simulate
+    _path, _interval = path, interval
+    _labels = 'job="%s"' % (job or os.path.abspath(m5.options.outdir))
+    _target = _last = None
@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import hashlib
+import argparse
+import threading
+from simpoint_utils import gem5_command, log_contains, run_gem5
+
+
+# A queue of gem5 runs in a directory shared by all nodes:
+#   pending/<job>.json           waiting to be claimed
+#   leased/<job>.json@<worker>   claimed by worker, its mtime is a heartbeat
+#   done/<job>.json              finished, the output is in its outdir
+#   failed/<job>.json            failed after all retries
+# Every change of state is a rename(), which is atomic on local and NFS file
+# systems, so exactly one worker wins each claim or takeback. Leases whose
+# heartbeat is older than the lease timeout (the worker or its node died)
+# are moved back to pending/ by any worker. A job runs into a temporary
+# directory next to its outdir which is renamed into place when it ends.
+
+STATES = ['pending', 'leased', 'done', 'failed', 'tmp', 'clock']
+
+
+def init(queue):
+    for state in STATES:
+        os.makedirs(os.path.join(queue, state), exist_ok=True)
+
+
+def job_name(outdir):
+    # Unique per outdir, and still readable
+    digest = hashlib.sha1(os.path.abspath(outdir).encode()).hexdigest()
+    return '%s-%s.json' % (os.path.basename(os.path.normpath(outdir)),
+                           digest[:12])
+
+
+def state_path(queue, state, name):
+    return os.path.join(queue, state, name)
+
+
+def fs_now(queue, worker):
+    # The clock of the shared file system, so that nodes with skewed clocks
+    # agree on which leases have expired
+    path = state_path(queue, 'clock', worker)
+    with open(path, 'a'):
+        pass
+    os.utime(path)
+    return os.stat(path).st_mtime
+
+
+#######################################
+#               Submit                #
+#######################################
+
+
+def outdir_arg(cmd):
+    # Index of gem5's --outdir= option, which precedes the script
+    return next(i for i, arg in enumerate(cmd) if arg.startswith('--outdir='))
+
+
+def submit(queue, cmd, outdir, done_msg=None, retries=0):
+    # cmd is a gem5_command() writing into outdir. A job finished or failed
+    # before is submitted again.
+    init(queue)
+    outdir = os.path.abspath(outdir)
+    name = job_name(outdir)
+    cmd = list(cmd)
+    cmd[outdir_arg(cmd)] = '--outdir=' + outdir
+    for state in ['done', 'failed']:
+        try:
+            os.remove(state_path(queue, state, name))
+        except FileNotFoundError:
+            pass
+    if os.path.exists(state_path(queue, 'pending', name)) or any(
+            n.startswith(name + '@')
+            for n in os.listdir(os.path.join(queue, 'leased'))):
+        return name
+
+    job = {'cmd': cmd, 'outdir': outdir, 'cwd': os.getcwd(),
+           'done': done_msg, 'retries': retries, 'submitted': time.time()}
+    tmp = state_path(queue, 'tmp', '%s.%s.%d' % (name, socket.gethostname(),
+                                                 os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp, state_path(queue, 'pending', name))
+    return name
+
+
+def wait(queue, name, poll=10):
+    # Return True if the job is done, False if it failed
+    while True:
+        if os.path.exists(state_path(queue, 'done', name)):
+            return True
+        if os.path.exists(state_path(queue, 'failed', name)):
+            return False
+        time.sleep(poll)
+
+
+def run(queue, cmd, outdir, done_msg=None, retries=0, poll=10):
+    # Drop-in for run_gem5() that runs cmd on whichever worker claims it
+    name = submit(queue, cmd, outdir, done_msg, retries)
+    return wait(queue, name, poll) and \
+        (done_msg is None or log_contains(outdir, done_msg))
+
+
+#######################################
+#                Work                 #
+#######################################
+
+
+def reap(queue, worker, timeout):
+    now = fs_now(queue, worker)
+    for lease in os.listdir(os.path.join(queue, 'leased')):
+        path = state_path(queue, 'leased', lease)
+        try:
+            expired = now - os.stat(path).st_mtime > timeout
+            if expired:
+                name, owner = lease.rsplit('@', 1)
+                os.rename(path, state_path(queue, 'pending', name))
+                print('Took back %s from %s' % (name, owner))
+        except FileNotFoundError:
+            # Finished or taken back by someone else meanwhile
+            pass
+
+
+def claim(queue, worker):
+    # Oldest job first
+    names = sorted(os.listdir(os.path.join(queue, 'pending')))
+    for name in names:
+        pending = state_path(queue, 'pending', name)
+        lease = state_path(queue, 'leased', '%s@%s' % (name, worker))
+        # The rename keeps the mtime, which must not look expired to reap()
+        # on another worker before the first heartbeat
+        try:
+            os.utime(pending)
+            os.rename(pending, lease)
+        except FileNotFoundError:
+            continue
+        return name, lease
+    return None
+
+
+def heartbeat(lease, interval, stop):
+    while not stop.wait(interval):
+        try:
+            os.utime(lease)
+        except FileNotFoundError:
+            print('Lost the lease %r' % lease)
+            return
+
+
+def publish(tmp, outdir, done_msg, worker):
+    # Move the output of a run into place. A complete output already there
+    # (from a worker whose lease was taken back) wins over ours.
+    if os.path.isdir(outdir):
+        if done_msg is not None and log_contains(outdir, done_msg):
+            shutil.rmtree(tmp)
+            return
+        stale = '%s.stale.%s' % (outdir, worker)
+        os.rename(outdir, stale)
+        shutil.rmtree(stale)
+    try:
+        os.rename(tmp, outdir)
+    except OSError:
+        shutil.rmtree(tmp)
+
+
+def finish(queue, name, lease, ok):
+    state = 'done' if ok else 'failed'
+    try:
+        os.rename(lease, state_path(queue, state, name))
+    except FileNotFoundError:
+        # The lease was taken back, but the job is finished all the same
+        try:
+            os.rename(state_path(queue, 'pending', name),
+                      state_path(queue, state, name))
+        except FileNotFoundError:
+            pass
+
+
+def run_job(queue, name, lease, worker, interval):
+    with open(lease) as f:
+        job = json.load(f)
+    outdir, done_msg = job['outdir'], job['done']
+    if done_msg is not None and log_contains(outdir, done_msg):
+        finish(queue, name, lease, True)
+        return True
+
+    stop = threading.Event()
+    beat = threading.Thread(target=heartbeat, args=(lease, interval, stop),
+                            daemon=True)
+    beat.start()
+    start = time.time()
+    try:
+        tmp = '%s.tmp.%s' % (outdir, worker)
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        cmd = list(job['cmd'])
+        cmd[outdir_arg(cmd)] = '--outdir=' + tmp
+        ok = run_gem5(cmd, tmp, job['retries'], cwd=job['cwd'],
+                      done=None if done_msg is None
+                      else lambda d: log_contains(d, done_msg))
+        publish(tmp, outdir, done_msg, worker)
+    except Exception as e:
+        # E.g. gem5 or the cwd missing on this node. The job fails instead
+        # of taking the worker down with its lease.
+        print('%s raised %s: %s' % (name, type(e).__name__, e))
+        ok = False
+    finally:
+        stop.set()
+        beat.join()
+    finish(queue, name, lease, ok)
+    print('%s %s in %.0fs' % (name, 'done' if ok else 'FAILED',
+                              time.time() - start))
+    return ok
+
+
+def work(queue, worker, timeout, interval, poll, exit_when_empty):
+    init(queue)
+    while True:
+        reap(queue, worker, timeout)
+        claimed = claim(queue, worker)
+        if claimed is not None:
+            run_job(queue, *claimed, worker, interval)
+            continue
+        if exit_when_empty and not any(
+                os.listdir(os.path.join(queue, state))
+                for state in ['pending', 'leased']):
+            return
+        time.sleep(poll)
+
+
+def status(queue):
+    init(queue)
+    for state in ['pending', 'leased', 'done', 'failed']:
+        names = sorted(os.listdir(os.path.join(queue, state)))
+        print('%-8s %d' % (state, len(names)))
+        if state == 'leased':
+            for lease in names:
+                name, worker = lease.rsplit('@', 1)
+                age = time.time() - os.stat(
+                    state_path(queue, state, lease)).st_mtime
+                print('  %s on %s, heartbeat %.0fs ago' % (name, worker, age))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run gem5 jobs from a queue directory shared by nodes.')
+    sub = parser.add_subparsers(dest='action', required=True)
+
+    p = sub.add_parser('submit', usage='%(prog)s queue -d outdir '
+                       '[options] -- gem5 script [script options]')
+    p.add_argument('queue')
+    p.add_argument('-d', '--outdir', required=True)
+    p.add_argument('--done', help='message in gem5.log of a finished run')
+    p.add_argument('--retries', type=int, default=0)
+
+    p = sub.add_parser('work')
+    p.add_argument('queue')
+    p.add_argument('-j', '--jobs', type=int, default=1)
+    p.add_argument('--lease-timeout', type=float, default=300)
+    p.add_argument('--heartbeat', type=float, default=30)
+    p.add_argument('--poll', type=float, default=10)
+    p.add_argument('--exit-when-empty', action='store_true')
+
+    p = sub.add_parser('status')
+    p.add_argument('queue')
+
+    # Everything after '--' is the command to submit
+    argv, command = sys.argv[1:], []
+    if '--' in argv:
+        i = argv.index('--')
+        argv, command = argv[:i], argv[i + 1:]
+    args = parser.parse_args(argv)
+
+    if args.action == 'submit':
+        if len(command) < 2:
+            parser.error('submit requires a gem5 binary and a script.')
+        cmd = gem5_command(command[0], os.path.abspath(args.outdir),
+                           command[1], command[2:])
+        print(submit(args.queue, cmd, args.outdir, args.done, args.retries))
+    elif args.action == 'work':
+        if args.heartbeat >= args.lease_timeout:
+            parser.error('--heartbeat must be shorter than --lease-timeout.')
+        host = '%s.%d' % (socket.gethostname(), os.getpid())
+        threads = [threading.Thread(
+            target=work, args=(args.queue, '%s.%d' % (host, i),
+                               args.lease_timeout, args.heartbeat,
+                               args.poll, args.exit_when_empty))
+            for i in range(args.jobs)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    else:
+        status(args.queue)
+
+
+if __name__ == '__main__':
+    main()